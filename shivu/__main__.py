@@ -3,121 +3,209 @@ import time
 import random
 import re
 import asyncio
+import logging
 from html import escape 
 from threading import Thread
-from flask import Flask
+from flask import Flask, Response
 import pyrogram
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.enums import ChatAction
-import wordfreq
-import nltk
-from nltk.corpus import words
-import json
 import os
 import aiofiles
-from typing import Dict, Set, Optional
+from typing import Dict, List, Optional, Set
+from types import SimpleNamespace
 from datetime import datetime
 from dotenv import load_dotenv
 from pyrogram.errors import FloodWait
+from shivu.lexicon import Cursor, UsedWordSet
+from shivu.lexicon_file import archive_word_list, archived_word_list, load_lexicon
+from shivu.metrics import CONTENT_TYPE, Registry
+from shivu.rejections import REJECTIONS_FILE, RejectionFilter
+from shivu.selection import SelectionPool
+from shivu.shards import chat_shard
+from shivu.sender import PRIORITY_ADMIN, PRIORITY_GAME, PRIORITY_LOG, PRIORITY_NAMES, LogDigest, SendScheduler, parse_log_level
+from shivu.storage import ChatStateManager, UsedWordsCache, clear_record, create_backend, disable_record, enable_record, update_record, words_record
 
 import nest_asyncio
 nest_asyncio.apply()
 flask_app = Flask(__name__)
 
-# Download NLTK words corpus if not already present
-try:
-    nltk.data.find('corpora/words')
-except LookupError:
-    try:
-        nltk.download('words')
-    except Exception as e:
-        print(f"Failed to download NLTK words corpus: {e}")
-
 # Load environment variables
 load_dotenv()
 API_ID = int(os.getenv("API_ID", "0"))
 API_HASH = os.getenv("API_HASH", "")
 SESSION_STRING = os.getenv("SESSION_STRING", "")
 LOG_CHAT_ID = int(os.getenv("LOG_CHAT_ID", "0"))
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "2.0"))  # Seconds between background config flushes
+FLUSH_THRESHOLD = int(os.getenv("FLUSH_THRESHOLD", "200"))  # Pending changes that trigger an early flush
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # json or sqlite
+SQLITE_FILE = os.getenv("SQLITE_FILE", "chat_state.db")
+WORD_CACHE_SIZE = int(os.getenv("WORD_CACHE_SIZE", "0")) or None  # Chats whose used words stay in memory, 0 for all
+LEXICON_FILE = os.getenv("LEXICON_FILE", "lexicon.bin")
+TYPING_DELAY = float(os.getenv("TYPING_DELAY", "1.5"))  # Minimum seconds between a prompt or rejection and our reply
+SPECULATIVE_FALLBACKS = int(os.getenv("SPECULATIVE_FALLBACKS", "2"))  # Extra candidates precomputed per prompt
+SELECTION_POOL = os.getenv("SELECTION_POOL", "thread")  # thread, process or inline
+SELECTION_WORKERS = int(os.getenv("SELECTION_WORKERS", "0"))  # Selection workers, 0 for up to 4 by CPU count
+BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", "3000"))  # Most history messages read per chat on restart
+BACKFILL_NEW_CHAT_LIMIT = int(os.getenv("BACKFILL_NEW_CHAT_LIMIT", "300"))  # Most history messages read on /on, with no last message to stop at
+BACKFILL_GAME_GAP = float(os.getenv("BACKFILL_GAME_GAP", "300"))  # Seconds of game bot silence taken as the start of the current game
+BACKFILL_PAGE_DELAY = float(os.getenv("BACKFILL_PAGE_DELAY", "1.0"))  # Seconds between history pages of 100 messages
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))  # This process's shard, set by python -m shivu.shards
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))  # Sessions sharing the chats through the SQLite store
+COMMAND_POLL_INTERVAL = float(os.getenv("COMMAND_POLL_INTERVAL", "1.0"))  # Seconds between checks for admin commands forwarded by other shards
+SEND_RATE = float(os.getenv("SEND_RATE", "20"))  # Outbound messages per second on average
+SEND_BURST = int(os.getenv("SEND_BURST", "5"))  # Outbound messages allowed back to back
+LOG_DIGEST_INTERVAL = float(os.getenv("LOG_DIGEST_INTERVAL", "10"))  # Seconds between log chat digests
+LOG_DIGEST_MAX_EVENTS = int(os.getenv("LOG_DIGEST_MAX_EVENTS", "50"))  # Events that trigger an early digest
+LOG_IMMEDIATE_LEVEL = parse_log_level(os.getenv("LOG_IMMEDIATE_LEVEL", "ERROR"))  # Events sent without batching
+
+# Map the compiled wordfreq vocabulary and NLTK retry lexicon; wordfreq/NLTK are only imported to rebuild a missing or stale file
+vocabulary, retry_lexicon, word_index = load_lexicon(LEXICON_FILE)  # word_index: shared word IDs behind every chat's used word bitset
+rejection_filter = RejectionFilter.load(word_index, REJECTIONS_FILE)  # Words rejected as "not in list" in any chat
+selection_pool = SelectionPool(SELECTION_POOL, SELECTION_WORKERS, vocabulary, retry_lexicon, word_index, LEXICON_FILE)
 
 # Authorized user IDs
 ADMIN_IDS = {678309690, 7360592638}
 GAME_BOT_ID = 840338206  # User ID for game bot responses
 
 # Initialize Pyrogram client
+if SHARD_COUNT > 1 and STORAGE_BACKEND != "sqlite":
+    raise ValueError("Sharded sessions share chat state through SQLite; set STORAGE_BACKEND=sqlite")
+
 app = Client(
-    "word_game_group",
+    "word_game_group" if SHARD_COUNT == 1 else f"word_game_group_{SHARD_INDEX}",
     api_id=API_ID,
     api_hash=API_HASH,
-    session_string=SESSION_STRING
+    session_string=SESSION_STRING,
+    sleep_threshold=0  # Every FloodWait reaches send_scheduler and backfill instead of being slept through inside Pyrogram
 )
 
+# Outbound messages: game replies first, then admin responses, then log chat messages
+send_scheduler = SendScheduler(lambda chat_id, text, **kwargs: app.send_message(chat_id, text, **kwargs), SEND_RATE, SEND_BURST,
+                               on_flood_wait=lambda chat_id, seconds: record_flood_wait(seconds))
+log_digest = LogDigest(lambda text, urgent: post_log(text, urgent), LOG_DIGEST_INTERVAL, LOG_DIGEST_MAX_EVENTS, LOG_IMMEDIATE_LEVEL)
+
 # Data structures
 enabled_chats: Dict[int, Dict[str, any]] = {}  # chat_id -> {alias, name, case}
-used_words: Dict[int, Set[str]] = {}  # chat_id -> set of used words
 last_prompt: Dict[int, Dict[str, any]] = {}  # chat_id -> {start_letter, min_length}
+word_cursors: Dict[int, Cursor] = {}  # chat_id -> vocabulary bucket positions past used words
+speculative: Dict[int, Dict[str, any]] = {}  # chat_id -> {prompt, primary candidates, retry candidates}
+chat_turns: Dict[int, Dict[str, any]] = {}  # chat_id -> {task, committed} for the turn being answered
+backfills: Dict[int, asyncio.Task] = {}  # chat_id -> history backfill in progress
+background_tasks: Set[asyncio.Task] = set()  # Long-running tasks, referenced so they are never garbage collected
+backfill_lock = asyncio.Lock()  # History is read one chat at a time to stay under Telegram's limits
 CONFIG_FILE = "chat_config.json"
+if STORAGE_BACKEND == "json":
+    archive_word_list(CONFIG_FILE, word_index)  # Snapshot bitsets stay readable when a wordfreq or NLTK update changes the lexicon
+storage = create_backend(STORAGE_BACKEND, CONFIG_FILE, SQLITE_FILE,
+                         new_set=lambda words=(): UsedWordSet.from_data(word_index, words, lambda fingerprint: archived_word_list(CONFIG_FILE, fingerprint)))
+state_manager = ChatStateManager(storage, FLUSH_INTERVAL, FLUSH_THRESHOLD, on_error=lambda e: report_save_error(e),
+                                 on_flush=lambda records, written, seconds: record_flush(records, written, seconds))
+
+# Function to keep a chat's used words in memory while they have unsaved changes or a turn or backfill is reading them
+def keep_used_words(chat_id: int) -> bool:
+    return state_manager.is_dirty(chat_id) or chat_id in chat_turns or chat_id in backfills
+
+used_words = UsedWordsCache(storage, WORD_CACHE_SIZE, keep_used_words)  # chat_id -> set of used words, loaded on first activity
 last_bot_message_id: Dict[int, int] = {}  # Track last bot message ID per chat
 INITIALIZED = False  # Flag to ensure load_config runs only once
 
+# Metrics served at /metrics in the Prometheus text format
+metrics = Registry()
+PROMPTS = metrics.counter("shivu_prompts_total", "Game prompts seen in enabled chats")
+PROMPT_TO_SEND = metrics.histogram("shivu_prompt_to_send_seconds", "Time from receiving a prompt to our answer being sent")
+SELECTION_SECONDS = metrics.histogram("shivu_selection_seconds", "Word selection time by chat case, or retry for NLTK retries", ["case"])
+WORDS_SENT = metrics.counter("shivu_words_sent_total", "Answers sent by word source", ["source"])
+REJECTIONS = metrics.counter("shivu_rejections_total", "Game bot rejections of our words by reason", ["reason"])
+RETRIES = metrics.counter("shivu_retries_total", "Rejection retries by outcome", ["result"])
+STATE_FLUSH_SECONDS = metrics.histogram("shivu_state_flush_seconds", "Duration of chat state writes to the storage backend")
+STATE_FLUSH_RECORDS = metrics.counter("shivu_state_flush_records_total", "Chat state records written to the storage backend")
+STATE_FLUSH_BYTES = metrics.counter("shivu_state_flush_bytes_total", "Bytes written by chat state flushes, where the backend reports them")
+SEND_SECONDS = metrics.histogram("shivu_send_seconds", "safe_send_message latency including queueing, by priority", ["priority"])
+FLOOD_WAITS = metrics.counter("shivu_flood_waits_total", "FloodWait errors raised by Telegram")
+FLOOD_WAIT_SECONDS = metrics.counter("shivu_flood_wait_seconds_total", "Seconds of FloodWait backoff imposed by Telegram")
+metrics.callback("shivu_rejection_filter_saved_total", "Retry round-trips avoided by the rejection filter, by selection",
+                 lambda: {(selection,): count for selection, count in rejection_filter.saved.items()}, ["selection"], kind='counter')
+metrics.callback("shivu_rejection_filter_words", "Words in the global rejection filter", lambda: {(): len(rejection_filter)})
+metrics.callback("shivu_used_words", "Used words per chat, for chats loaded in memory",
+                 lambda: {(str(chat_id),): len(words) for chat_id, words in list(used_words.items())}, ["chat"])
+
+def record_flood_wait(seconds: float):
+    FLOOD_WAITS.inc()
+    FLOOD_WAIT_SECONDS.inc(seconds)
+
+def record_flush(records: int, written: Optional[int], seconds: float):
+    STATE_FLUSH_SECONDS.observe(seconds)
+    STATE_FLUSH_RECORDS.inc(records)
+    if written is not None:
+        STATE_FLUSH_BYTES.inc(written)
+
 @flask_app.route("/")
 def index():
     return "Shivu Daemon Running on 7860"
 
+@flask_app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
 def run_flask():
-    flask_app.run(host="0.0.0.0", port=7860, debug=False, use_reloader=False)
+    flask_app.run(host="0.0.0.0", port=7860 + SHARD_INDEX, debug=False, use_reloader=False)  # One port per shard
 
 # Function to load chat config
 async def load_config():
-    global enabled_chats, used_words
-    if os.path.exists(CONFIG_FILE):
-        try:
-            async with aiofiles.open(CONFIG_FILE, 'r') as f:
-                data = json.loads(await f.read())
-                enabled_chats = {int(k): v for k, v in data.get('enabled_chats', {}).items()}
-                used_words = {int(k): set(v) for k, v in data.get('used_words', {}).items()}
-        except Exception as e:
-            await safe_send_message(LOG_CHAT_ID, f"Failed to load config: {e}")
-            enabled_chats = {}
-            used_words = {}
-    else:
-        enabled_chats = {}
-        used_words = {}
-
-# Function to save chat config
-async def save_config():
+    global enabled_chats
+    word_cursors.clear()
+    speculative.clear()
+    used_words.clear()
     try:
-        async with aiofiles.open(CONFIG_FILE, 'w') as f:
-            await f.write(json.dumps({
-                'enabled_chats': enabled_chats,
-                'used_words': {k: list(v) for k, v in used_words.items()}
-            }))
+        enabled_chats = {chat_id: info for chat_id, info in (await storage.load_chats()).items() if chat_shard(chat_id, info, SHARD_COUNT) == SHARD_INDEX}
     except Exception as e:
-        await safe_send_message(LOG_CHAT_ID, f"Failed to save config: {e}")
+        await safe_send_message(LOG_CHAT_ID, f"Failed to load config: {e}", level=logging.ERROR)
+        enabled_chats = {}
+    last_prompt.clear()
+    for chat_id, info in enabled_chats.items():
+        if info.get('last_prompt'):
+            last_prompt[chat_id] = dict(info['last_prompt'])
+
+# Function to queue chat config changes; the state manager writes them to the journal in the background
+def save_config(*records):
+    state_manager.record(*records)
+
+async def report_save_error(e: Exception):
+    await safe_send_message(LOG_CHAT_ID, f"Failed to save config: {e}", level=logging.ERROR)
 
 # Function to generate 4-digit alias
 def generate_alias() -> str:
     return str(random.randint(1000, 9999))
 
-# Function for safe message sending with flood control
-async def safe_send_message(chat_id, text, **kwargs):
+# Function for safe message sending through the outbound scheduler
+async def safe_send_message(chat_id, text, priority=None, level=logging.INFO, **kwargs):
+    if priority is None:
+        priority = PRIORITY_LOG if chat_id == LOG_CHAT_ID else PRIORITY_GAME
+    if priority == PRIORITY_LOG:
+        # Log chat events are batched into digests; events at LOG_IMMEDIATE_LEVEL or above go out right away
+        log_digest.add(text, level)
+        return None
     try:
-        message = await app.send_message(chat_id, text, **kwargs)
-        if chat_id in enabled_chats and 'disable_notification' in kwargs and kwargs['disable_notification']:
-            last_bot_message_id[chat_id] = message.id
-        return message
-    except FloodWait as e:
-        await asyncio.sleep(e.x)
-        message = await app.send_message(chat_id, text, **kwargs)
+        with SEND_SECONDS.time(priority=PRIORITY_NAMES[priority]):
+            message = await send_scheduler.submit(chat_id, text, priority, **kwargs)
         if chat_id in enabled_chats and 'disable_notification' in kwargs and kwargs['disable_notification']:
             last_bot_message_id[chat_id] = message.id
         return message
     except Exception as e:
         print(f"Error sending message to {chat_id}: {e}")
         if chat_id != LOG_CHAT_ID:
-            await safe_send_message(LOG_CHAT_ID, f"Error sending message to {chat_id}: {e}")
+            await safe_send_message(LOG_CHAT_ID, f"Error sending message to {chat_id}: {e}", level=logging.ERROR)
         return None
 
+# Function to queue a log chat message without waiting, so a slow or flood-limited log chat never holds up a handler
+def post_log(text, urgent):
+    send_scheduler.post(LOG_CHAT_ID, text, PRIORITY_ADMIN if urgent else PRIORITY_LOG).add_done_callback(report_log_failure)
+
+def report_log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error sending message to {LOG_CHAT_ID}: {future.exception()}")
+
 # Function to log rejected words to rejections.txt
 async def log_rejected_word(chat_id: int, word: str, reason: str):
     """
@@ -126,125 +214,203 @@ async def log_rejected_word(chat_id: int, word: str, reason: str):
     try:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         log_entry = f"[{timestamp}] Chat ID: {chat_id}, Word: {word}, Reason: {reason}\n"
-        async with aiofiles.open("rejections.txt", "a") as f:
+        async with aiofiles.open(REJECTIONS_FILE, "a") as f:
             await f.write(log_entry)
     except Exception as e:
-        await safe_send_message(LOG_CHAT_ID, f"Failed to log rejected word '{word}' to rejections.txt: {e}")
+        await safe_send_message(LOG_CHAT_ID, f"Failed to log rejected word '{word}' to rejections.txt: {e}", level=logging.ERROR)
+
+# Ranking used per case: (strategy score column precomputed in the lexicon or None for plain frequency, log label)
+# A new mode is a new column in shivu.lexicon.STRATEGY_SCORES plus an entry here
+CASE_STRATEGIES = {
+    # Case 1: Pick highest frequency word
+    '1': (None, "Case 1"),
+    # Case 4: high tier (freq >= 0.000001) words ending with x, z, y, then any word ending with x, y, z, then any word
+    '4': ('xyz', "Case 4, XYZ ranking"),
+    # Case 5: words ending with letters that leave the next player the fewest common answers
+    '5': ('trap', "Case 5, trap ranking"),
+}
+CASE_MODES = {'4': " (XYZ Priority Mode)", '5': " (Trap Mode)"}
+
+# Function to rank wordfreq candidates for a prompt on the selection pool
+async def select_game_words(start_letter: str, min_length: int, chat_id: int, case: str, count: int = 1):
+    """
+    Return up to count (word, frequency, label) candidates for the prompt, best first in the case's ranking,
+    without marking them used.
+    """
+    if case not in CASE_STRATEGIES:
+        return []
+    strategy, label = CASE_STRATEGIES[case]
+    with SELECTION_SECONDS.time(case=case):
+        candidates, excluded = await selection_pool.rank_game_words(strategy, label, start_letter, min_length, used_words[chat_id],
+                                                                    word_cursors.setdefault(chat_id, {}), rejection_filter.words, count)
+    if excluded:
+        rejection_filter.record_saved('wordfreq')
+    return candidates
+
+# Function to rank NLTK retry candidates for a prompt on the selection pool
+async def select_retry_words(start_letter: str, min_length: int, chat_id: int, count: int = 1):
+    """Return up to count NLTK words for a retry, alphabetically first unused ones first."""
+    with SELECTION_SECONDS.time(case='retry'):
+        candidates, excluded = await selection_pool.rank_retry_words(start_letter, min_length, used_words[chat_id], rejection_filter.words, count)
+    if excluded:
+        rejection_filter.record_saved('nltk')
+    return candidates
+
+# Function to precompute the answer and retry fallbacks as soon as a prompt is seen
+async def speculate(chat_id: int, start_letter: str, min_length: int, case: str):
+    speculative[chat_id] = {
+        'prompt': (start_letter.lower(), min_length),
+        'primary': await select_game_words(start_letter, min_length, chat_id, case, count=1 + SPECULATIVE_FALLBACKS),
+        'retry': await select_retry_words(start_letter, min_length, chat_id, count=1 + SPECULATIVE_FALLBACKS),
+    }
+
+# Function to drop speculative candidates that other players have used or the game bot has rejected meanwhile
+def invalidate_speculation(chat_id: int, words):
+    entry = speculative.get(chat_id)
+    if entry:
+        words = set(words)
+        entry['primary'] = [candidate for candidate in entry['primary'] if candidate[0].lower() not in words]
+        entry['retry'] = [word for word in entry['retry'] if word.lower() not in words]
+
+# Function to take the next still-unused speculative candidate for the prompt
+def pop_speculative(chat_id: int, kind: str, start_letter: str, min_length: int):
+    entry = speculative.get(chat_id)
+    if not entry or entry['prompt'] != (start_letter.lower(), min_length):
+        return None
+    while entry[kind]:
+        candidate = entry[kind].pop(0)
+        word = candidate[0] if kind == 'primary' else candidate
+        if word.lower() not in used_words[chat_id] and word.lower() not in rejection_filter:
+            return candidate
+    return None
+
+# Function to wait out whatever is left of the typing delay
+async def typing_floor(started: float):
+    await asyncio.sleep(max(0.0, TYPING_DELAY - (time.monotonic() - started)))
 
 # Function to retrieve game word
 async def get_game_word(start_letter: str, min_length: int, chat_id: int, case: str) -> Optional[str]:
     """
     Get a word starting with start_letter, at least min_length, for the given chat.
-    Case 1: Use wordfreq (highest frequency).
-    Case 4: Try words ending with x, then z, then y with freq >= 0.000001, else any word ending with x,y,z, else any word.
+    Uses the speculative candidates computed when the prompt arrived, else ranks afresh.
     Avoid chat-specific duplicates. Capitalize first letter for output.
     """
-    if chat_id not in used_words:
-        used_words[chat_id] = set()
+    await used_words.load(chat_id)
     
-    # Get wordfreq words
-    wordfreq_words = wordfreq.top_n_list('en', 321180)
-    matching_words = [
-        word for word in wordfreq_words
-        if len(word) >= min_length
-        and word.lower().startswith(start_letter.lower())
-        and re.match(r'^[a-zA-Z]+$', word)
-        and word.lower() not in used_words[chat_id]
-    ]
+    candidate = pop_speculative(chat_id, 'primary', start_letter, min_length)
+    if candidate is None:
+        candidates = await select_game_words(start_letter, min_length, chat_id, case)
+        candidate = candidates[0] if candidates else None
+    if candidate:
+        commit_turn(chat_id)
+        selected_word, frequency, label = candidate
+        used_words[chat_id].add(selected_word.lower())
+        save_config(words_record(chat_id, [selected_word.lower()]))
+        await safe_send_message(LOG_CHAT_ID, f"Sent word ({label}): {selected_word} (length={len(selected_word)}, freq={frequency:.6f}) to chat {chat_id} ({enabled_chats[chat_id]['name']})")
+        return selected_word[0].upper() + selected_word[1:].lower()
     
-    if matching_words:
-        if case == '1':
-            # Case 1: Pick highest frequency word
-            word_freq = [(word, wordfreq.word_frequency(word.lower(), 'en')) for word in matching_words]
-            if not word_freq:
-                await safe_send_message(LOG_CHAT_ID, f"No wordfreq words meet min_length {min_length} for '{start_letter}' in chat {chat_id}")
-                return None
-            word_freq.sort(key=lambda x: x[1], reverse=True)
-            selected_word = word_freq[0][0]
-            frequency = word_freq[0][1]
-            used_words[chat_id].add(selected_word.lower())
-            await save_config()
-            await safe_send_message(LOG_CHAT_ID, f"Sent word (Case 1): {selected_word} (length={len(selected_word)}, freq={frequency:.6f}) to chat {chat_id} ({enabled_chats[chat_id]['name']})")
-            return selected_word[0].upper() + selected_word[1:].lower()
-        elif case == '4':
-            target_end_letters = ['x', 'z', 'y']
-            # Phase 1: Try words with freq >= 0.000001 ending with 'x', 'z', 'y'
-            for end_letter in target_end_letters:
-                valid_words = [
-                    (word, wordfreq.word_frequency(word.lower(), 'en'))
-                    for word in matching_words
-                    if word.lower().endswith(end_letter)
-                    and wordfreq.word_frequency(word.lower(), 'en') >= 0.000001
-                ]
-                if valid_words:
-                    valid_words.sort(key=lambda x: x[1], reverse=True)  # Highest frequency first
-                    selected_word = valid_words[0][0]
-                    frequency = valid_words[0][1]
-                    used_words[chat_id].add(selected_word.lower())
-                    await save_config()
-                    await safe_send_message(LOG_CHAT_ID, f"Sent word (Case 4, ends with {end_letter}, freq >= 0.000001): {selected_word} (length={len(selected_word)}, freq={frequency:.6f}) to chat {chat_id} ({enabled_chats[chat_id]['name']})")
-                    return selected_word[0].upper() + selected_word[1:].lower()
-            
-            # Phase 2: No high-freq words found, try any word ending with 'x', 'y', 'z'
-            for end_letter in ['x', 'y', 'z']:  # Different order for fallback
-                valid_words = [
-                    (word, wordfreq.word_frequency(word.lower(), 'en'))
-                    for word in matching_words
-                    if word.lower().endswith(end_letter)
-                ]
-                if valid_words:
-                    valid_words.sort(key=lambda x: x[1], reverse=True)
-                    selected_word = valid_words[0][0]
-                    frequency = valid_words[0][1]
-                    used_words[chat_id].add(selected_word.lower())
-                    await save_config()
-                    await safe_send_message(LOG_CHAT_ID, f"Sent word (Case 4, ends with {end_letter}, any freq): {selected_word} (length={len(selected_word)}, freq={frequency:.6f}) to chat {chat_id} ({enabled_chats[chat_id]['name']})")
-                    return selected_word[0].upper() + selected_word[1:].lower()
-            
-            # Fallback: Any word matching start_letter and min_length
-            word_freq = [(word, wordfreq.word_frequency(word.lower(), 'en')) for word in matching_words]
-            if word_freq:
-                word_freq.sort(key=lambda x: x[1], reverse=True)
-                selected_word = word_freq[0][0]
-                frequency = word_freq[0][1]
-                used_words[chat_id].add(selected_word.lower())
-                await save_config()
-                await safe_send_message(LOG_CHAT_ID, f"Sent word (Case 4, fallback): {selected_word} (length={len(selected_word)}, freq={frequency:.6f}) to chat {chat_id} ({enabled_chats[chat_id]['name']})")
-                return selected_word[0].upper() + selected_word[1:].lower()
-    
-    await safe_send_message(LOG_CHAT_ID, f"No valid wordfreq word found for '{start_letter}' with min length {min_length} in chat {chat_id} ({enabled_chats[chat_id]['name']})")
+    await safe_send_message(LOG_CHAT_ID, f"No valid wordfreq word found for '{start_letter}' with min length {min_length} in chat {chat_id} ({enabled_chats[chat_id]['name']})", level=logging.WARNING)
     return None
 
+# Function to find the shard serving a chat
+async def chat_owner(chat_id: int, pinned: Optional[int] = None) -> int:
+    """
+    A chat enabled on some shard belongs to it. A chat not enabled anywhere belongs to the pinned shard,
+    else to its default shard. Ownership is read from the shared store, which shards flush on /on and /off.
+    """
+    if SHARD_COUNT == 1 or chat_id in enabled_chats:
+        return SHARD_INDEX
+    info = (await storage.load_chats()).get(chat_id)
+    if info is None and pinned is not None:
+        return pinned % SHARD_COUNT
+    return chat_shard(chat_id, info, SHARD_COUNT)
+
+# Function to identify an admin command the same way on every shard that received it
+def command_key(message) -> str:
+    forwarded_key = getattr(message, 'command_key', None)
+    if forwarded_key:
+        return forwarded_key
+    return f"{message.chat.id}:{message.from_user.id}:{int(message.date.timestamp())}:{message.text}"
+
+# Function to decide whether this shard runs an admin command for a chat
+async def route_command(message, chat_id: int, pinned: Optional[int] = None) -> bool:
+    """
+    The shard serving the chat runs it. Any other shard that received it forwards it there through the shared
+    store, so commands reach their chat even when the admin messaged a single session. When several shards
+    received the command, the first one to claim it runs it.
+    """
+    if SHARD_COUNT == 1:
+        return True
+    owner = await chat_owner(chat_id, pinned)
+    if owner != SHARD_INDEX:
+        await storage.forward_command(command_key(message), owner, {'key': command_key(message), 'text': message.text, 'from_user': message.from_user.id})
+        return False
+    return await storage.claim_command(command_key(message))
+
+# Function to answer an admin command rejected before routing once, however many shards received it
+async def reply_once(message, text: str):
+    if SHARD_COUNT == 1 or await storage.claim_command(command_key(message)):
+        await safe_send_message(LOG_CHAT_ID, text, priority=PRIORITY_ADMIN)
+
+# Function to run the admin commands other shards forwarded to this one
+async def run_forwarded_commands():
+    handlers = {'on': enable_chat, 'off': disable_chat, 'clear': clear_words, 'usedwords': show_used_words}
+    while True:
+        await asyncio.sleep(COMMAND_POLL_INTERVAL)
+        try:
+            for command in await storage.take_commands(SHARD_INDEX):
+                words = command['text'].split()
+                name = words[0].lstrip('/').split('@')[0].lower()
+                message = SimpleNamespace(text=command['text'], command=[name] + words[1:], command_key=command['key'],
+                                          from_user=SimpleNamespace(id=command['from_user']))
+                await handlers[name](app, message)
+        except Exception as e:
+            log_digest.add(f"Failed to run forwarded admin commands: {e}", logging.ERROR)
+
+# Function to label admin responses with the shard that sent them
+def shard_label() -> str:
+    return f"[Shard {SHARD_INDEX}] " if SHARD_COUNT > 1 else ""
+
 # Command handler: Enable chat
 @app.on_message(filters.command("on"))
 async def enable_chat(client, message):
     if message.from_user.id not in ADMIN_IDS:
         print(f"Unauthorized /on attempt by user {message.from_user.id}")
         return
-    if len(message.command) != 3:
-        await safe_send_message(LOG_CHAT_ID, "Usage: /on {chat_id} {case}")
+    if len(message.command) not in (3, 4):
+        await reply_once(message, "Usage: /on {chat_id} {case} [shard]")
         return
     try:
         chat_id = int(message.command[1])
         case = message.command[2]
-        if case not in ['1', '4']:
-            await safe_send_message(LOG_CHAT_ID, f"Failed to enable chat {chat_id}: Invalid case {case}")
+        pinned = int(message.command[3]) if len(message.command) == 4 else None
+        if not await route_command(message, chat_id, pinned):
+            return
+        if case not in CASE_STRATEGIES:
+            await safe_send_message(LOG_CHAT_ID, f"Failed to enable chat {chat_id}: Invalid case {case}", priority=PRIORITY_ADMIN)
             return
         if chat_id not in enabled_chats:
             chat = await client.get_chat(chat_id)
             chat_name = chat.title if chat.type in ["group", "supergroup"] else chat.username or f"{chat.first_name or ''} {chat.last_name or ''}".strip()
             alias = generate_alias()
             enabled_chats[chat_id] = {"alias": alias, "name": chat_name, "case": case}
-            used_words[chat_id] = set()
-            await save_config()
-            log_message = f"Enabled chat {chat_id} ({chat_name}) with alias {alias}, case {case}"
-            if case == '4':
-                log_message += " (XYZ Priority Mode)"
-            await safe_send_message(LOG_CHAT_ID, log_message)
+            if SHARD_COUNT > 1:
+                enabled_chats[chat_id]["shard"] = SHARD_INDEX
+            used_words[chat_id] = UsedWordSet(word_index)
+            word_cursors.pop(chat_id, None)
+            save_config(enable_record(chat_id, dict(enabled_chats[chat_id])))
+            if SHARD_COUNT > 1:
+                await state_manager.flush()  # Other shards route this chat's commands by the stored owner
+            log_message = f"{shard_label()}Enabled chat {chat_id} ({chat_name}) with alias {alias}, case {case}"
+            log_message += CASE_MODES.get(case, "")
+            await safe_send_message(LOG_CHAT_ID, log_message, priority=PRIORITY_ADMIN)
+            start_backfill(chat_id)
         else:
-            await safe_send_message(LOG_CHAT_ID, f"Chat {chat_id} ({enabled_chats[chat_id]['name']}) is already enabled with alias {enabled_chats[chat_id]['alias']}, case {enabled_chats[chat_id]['case']}")
-    except (ValueError, pyrogram.errors.exceptions.bad_request_400.PeerIdInvalid):
-        await safe_send_message(LOG_CHAT_ID, f"Failed to enable chat: Invalid chat ID {message.command[1]}")
+            await safe_send_message(LOG_CHAT_ID, f"Chat {chat_id} ({enabled_chats[chat_id]['name']}) is already enabled with alias {enabled_chats[chat_id]['alias']}, case {enabled_chats[chat_id]['case']}", priority=PRIORITY_ADMIN)
+    except ValueError:
+        await reply_once(message, f"Failed to enable chat: Invalid chat ID {message.command[1]}")
+    except pyrogram.errors.exceptions.bad_request_400.PeerIdInvalid:  # Raised after routing, on the one shard running the command
+        await safe_send_message(LOG_CHAT_ID, f"Failed to enable chat: Invalid chat ID {message.command[1]}", priority=PRIORITY_ADMIN)
 
 # Command handler: Disable chat
 @app.on_message(filters.command("off"))
@@ -253,23 +419,31 @@ async def disable_chat(client, message):
         print(f"Unauthorized /off attempt by user {message.from_user.id}")
         return
     if len(message.command) != 2:
-        await safe_send_message(LOG_CHAT_ID, "Usage: /off {chat_id}")
+        await reply_once(message, "Usage: /off {chat_id}")
         return
     try:
         chat_id = int(message.command[1])
+        if not await route_command(message, chat_id):
+            return
         if chat_id in enabled_chats:
             alias = enabled_chats[chat_id]["alias"]
             name = enabled_chats[chat_id]["name"]
             case = enabled_chats[chat_id]["case"]
             enabled_chats.pop(chat_id)
             used_words.pop(chat_id, None)
+            word_cursors.pop(chat_id, None)
+            speculative.pop(chat_id, None)
+            cancel_turn(chat_id)
+            cancel_backfill(chat_id)
             last_prompt.pop(chat_id, None)
-            await save_config()
-            await safe_send_message(LOG_CHAT_ID, f"Disabled chat {chat_id} ({name}) with alias {alias}, case {case}")
+            save_config(disable_record(chat_id))
+            if SHARD_COUNT > 1:
+                await state_manager.flush()
+            await safe_send_message(LOG_CHAT_ID, f"{shard_label()}Disabled chat {chat_id} ({name}) with alias {alias}, case {case}", priority=PRIORITY_ADMIN)
         else:
-            await safe_send_message(LOG_CHAT_ID, f"Failed to disable chat {chat_id}: Not enabled")
+            await safe_send_message(LOG_CHAT_ID, f"Failed to disable chat {chat_id}: Not enabled", priority=PRIORITY_ADMIN)
     except ValueError:
-        await safe_send_message(LOG_CHAT_ID, f"Failed to disable chat: Invalid chat ID {message.command[1]}")
+        await reply_once(message, f"Failed to disable chat: Invalid chat ID {message.command[1]}")
 
 # Command handler: Clear used words
 @app.on_message(filters.command("clear"))
@@ -278,18 +452,23 @@ async def clear_words(client, message):
         print(f"Unauthorized /clear attempt by user {message.from_user.id}")
         return
     if len(message.command) != 2:
-        await safe_send_message(LOG_CHAT_ID, "Usage: /clear {chat_id}")
+        await reply_once(message, "Usage: /clear {chat_id}")
         return
     try:
         chat_id = int(message.command[1])
+        if not await route_command(message, chat_id):
+            return
         if chat_id in enabled_chats:
-            used_words[chat_id] = set()
-            await save_config()
-            await safe_send_message(LOG_CHAT_ID, f"Cleared used words for chat {chat_id} ({enabled_chats[chat_id]['name']}) with alias {enabled_chats[chat_id]['alias']}, case {enabled_chats[chat_id]['case']}")
+            cancel_backfill(chat_id)
+            used_words[chat_id] = UsedWordSet(word_index)
+            word_cursors.pop(chat_id, None)
+            speculative.pop(chat_id, None)
+            save_config(clear_record(chat_id))
+            await safe_send_message(LOG_CHAT_ID, f"Cleared used words for chat {chat_id} ({enabled_chats[chat_id]['name']}) with alias {enabled_chats[chat_id]['alias']}, case {enabled_chats[chat_id]['case']}", priority=PRIORITY_ADMIN)
         else:
-            await safe_send_message(LOG_CHAT_ID, f"Failed to clear words for chat {chat_id}: Not enabled")
+            await safe_send_message(LOG_CHAT_ID, f"Failed to clear words for chat {chat_id}: Not enabled", priority=PRIORITY_ADMIN)
     except ValueError:
-        await safe_send_message(LOG_CHAT_ID, f"Failed to clear words: Invalid chat ID {message.command[1]}")
+        await reply_once(message, f"Failed to clear words: Invalid chat ID {message.command[1]}")
 
 # Command handler: Show enabled chats
 @app.on_message(filters.command("runs"))
@@ -301,9 +480,9 @@ async def show_enabled_chats(client, message):
         response = "Enabled chats:\n"
         for chat_id, info in enabled_chats.items():
             response += f"Chat ID: {chat_id}, Name: {info['name']}, Alias: {info['alias']}, Case: {info['case']}\n"
-        await safe_send_message(LOG_CHAT_ID, f"Listed enabled chats:\n{response}")
+        await safe_send_message(LOG_CHAT_ID, f"{shard_label()}Listed enabled chats:\n{response}\n{rejection_filter.summary()}", priority=PRIORITY_ADMIN)
     else:
-        await safe_send_message(LOG_CHAT_ID, "No chats are enabled")
+        await safe_send_message(LOG_CHAT_ID, f"{shard_label()}No chats are enabled\n{rejection_filter.summary()}", priority=PRIORITY_ADMIN)
 
 # Command handler: Show used words
 @app.on_message(filters.command("usedwords"))
@@ -312,21 +491,298 @@ async def show_used_words(client, message):
         print(f"Unauthorized /usedwords attempt by user {message.from_user.id}")
         return
     if len(message.command) != 2:
-        await safe_send_message(LOG_CHAT_ID, "Usage: /usedwords {chat_id}")
+        await reply_once(message, "Usage: /usedwords {chat_id}")
         return
     try:
         chat_id = int(message.command[1])
+        if not await route_command(message, chat_id):
+            return
         if chat_id in enabled_chats:
-            if chat_id in used_words and used_words[chat_id]:
-                words_list = sorted(list(used_words[chat_id]))
+            await state_manager.flush()
+            words_list = await storage.list_words(chat_id)
+            if words_list:
                 response = f"Used words for chat {chat_id} ({enabled_chats[chat_id]['name']}, case {enabled_chats[chat_id]['case']}):\n" + ", ".join(words_list)
             else:
                 response = f"No used words for chat {chat_id} ({enabled_chats[chat_id]['name']}, case {enabled_chats[chat_id]['case']})"
-            await safe_send_message(LOG_CHAT_ID, response)
+            await safe_send_message(LOG_CHAT_ID, response, priority=PRIORITY_ADMIN)
         else:
-            await safe_send_message(LOG_CHAT_ID, f"Failed to show used words: Chat {chat_id} is not enabled")
+            await safe_send_message(LOG_CHAT_ID, f"Failed to show used words: Chat {chat_id} is not enabled", priority=PRIORITY_ADMIN)
     except ValueError:
-        await safe_send_message(LOG_CHAT_ID, f"Failed to show used words: Invalid chat ID {message.command[1]}")
+        await reply_once(message, f"Failed to show used words: Invalid chat ID {message.command[1]}")
+
+# Precompiled game message patterns
+PROMPT_MARKER = "Your word must start with"  # Cheap substring test before the prompt regex
+PROMPT_PATTERN = re.compile(r"(?!)")  # Matches nothing until load_identity knows whose turn to look for
+
+# Function to build the regex for game prompts addressed to the given Telegram user
+def prompt_pattern(name: str, username: Optional[str]) -> re.Pattern:
+    player = re.escape(name) + (f" @{re.escape(username)}" if username else "")
+    return re.compile(rf"Turn: {player} \(Next: .+?\)\nYour word must start with (\w) and include at least (\d+) letters\.")
+
+# Function to read this session's name and username; each shard runs as a different user and answers only its own turns
+async def load_identity(client):
+    global PROMPT_PATTERN
+    me = await client.get_me()
+    name = " ".join(filter(None, [me.first_name, me.last_name]))
+    PROMPT_PATTERN = prompt_pattern(name, me.username)
+    print(f"Answering prompts for {name}" + (f" @{me.username}" if me.username else ""))
+# Game bot replies: invalid word, accepted word, word already used
+VERDICT_PATTERN = re.compile(r"^(\w+) (?:(?P<invalid>is not in my list of words)|(?P<accepted>is accepted)|(?P<used>has been used))$")
+NON_LETTERS = re.compile(r'[^a-zA-Z\s]')
+WHITESPACE = re.compile(r'\s+')
+
+MESSAGE_CHATTER = "chatter"
+MESSAGE_PROMPT = "prompt"
+MESSAGE_VERDICT = "verdict"
+
+# Function to classify a game chat message in one pass
+def classify_message(message, chat_id: int):
+    """
+    Return (kind, match): a game prompt, a game bot verdict on our last word, or plain chatter (match None).
+    Sender and reply checks run before any regex work.
+    """
+    text = message.text
+    if not (message.from_user and message.from_user.id == GAME_BOT_ID):
+        return MESSAGE_CHATTER, None  # Players pasting game text get no answer
+    if message.reply_to_message and message.reply_to_message.id == last_bot_message_id.get(chat_id):
+        match = VERDICT_PATTERN.match(WHITESPACE.sub(' ', NON_LETTERS.sub('', text).strip()))
+        if match:
+            return MESSAGE_VERDICT, match
+    elif PROMPT_MARKER in text:
+        match = PROMPT_PATTERN.match(text)
+        if match:
+            return MESSAGE_PROMPT, match
+    return MESSAGE_CHATTER, None
+
+# Function to add every new word of a chatter message to used_words with a single state update
+def ingest_words(chat_id: int, text: str):
+    chat_words = used_words[chat_id]
+    new_words = [word for word in dict.fromkeys(NON_LETTERS.sub('', text).lower().split()) if word not in chat_words]
+    if new_words:
+        chat_words.update(new_words)
+        invalidate_speculation(chat_id, new_words)
+        save_config(words_record(chat_id, new_words))
+
+# Function to start a chat's turn (answering a prompt or retrying a rejection) as a background task
+def start_turn(chat_id: int, work) -> asyncio.Task:
+    """
+    Only one turn per chat is active. A newer turn cancels an older one that has not yet committed
+    a word, then waits for it to finish, so chats never answer out of order; other chats run in parallel.
+    """
+    previous = chat_turns.get(chat_id)
+    if previous and not previous['committed']:
+        previous['task'].cancel()
+    turn = {'committed': False}
+    turn['task'] = asyncio.create_task(run_turn(chat_id, turn, previous, work))
+    chat_turns[chat_id] = turn
+    return turn['task']
+
+async def run_turn(chat_id: int, turn, previous, work):
+    try:
+        if previous:
+            await asyncio.wait([previous['task']])  # Unlike gather, never cancels the previous turn
+        await work
+    except asyncio.CancelledError:
+        print(f"Turn in chat {chat_id} superseded by a newer prompt")
+    except Exception as e:
+        await safe_send_message(LOG_CHAT_ID, f"Error answering in chat {chat_id}: {e}", level=logging.ERROR)
+    finally:
+        work.close()  # No-op unless cancelled before it started
+        if chat_turns.get(chat_id) is turn:
+            del chat_turns[chat_id]
+
+# Function to drop a chat's turn unless it has already committed its word
+def cancel_turn(chat_id: int):
+    turn = chat_turns.get(chat_id)
+    if turn and not turn['committed']:
+        turn['task'].cancel()
+
+# Function to mark the running turn as committed; from here on a newer prompt waits for it instead of cancelling it
+def commit_turn(chat_id: int):
+    turn = chat_turns.get(chat_id)
+    if turn and turn['task'] is asyncio.current_task():
+        turn['committed'] = True
+
+# Function to check for a turn that has not yet sent its word
+def turn_pending(chat_id: int) -> bool:
+    turn = chat_turns.get(chat_id)
+    return bool(turn) and not turn['committed'] and not turn['task'].done()
+
+# Function to answer a game prompt
+async def answer_prompt(client, chat_id: int, start_letter: str, min_length: int, case: str, received: float):
+    started = time.monotonic()
+    try:
+        await client.send_chat_action(chat_id, ChatAction.TYPING)
+    except Exception as e:
+        await safe_send_message(LOG_CHAT_ID, f"Error sending typing action to {chat_id}: {e}", level=logging.WARNING)
+    await speculate(chat_id, start_letter, min_length, case)
+    await typing_floor(started)
+    
+    word = await get_game_word(start_letter, min_length, chat_id, case)
+    if word:
+        if await safe_send_message(chat_id, word, disable_notification=True):
+            PROMPT_TO_SEND.observe(time.monotonic() - received)
+            WORDS_SENT.inc(source='wordfreq')
+    else:
+        await safe_send_message(LOG_CHAT_ID, f"No valid word found for prompt in chat {chat_id}. Consider clearing used words with /clear.", level=logging.WARNING)
+
+# Function to answer the last prompt again with an NLTK word after a rejection
+async def answer_rejection(client, chat_id: int, invalid_word: str, rejection_reason: str):
+    if chat_id not in last_prompt:
+        await safe_send_message(LOG_CHAT_ID, f"No prompt data available for retry in chat {chat_id}. Scanning chat history...")
+        try:
+            async for msg in app.get_chat_history(chat_id, limit=20):
+                prompt_match = PROMPT_PATTERN.match(msg.text) if msg.text else None
+                if prompt_match:
+                    start_letter = prompt_match.group(1)
+                    min_length = int(prompt_match.group(2))
+                    last_prompt[chat_id] = {'start_letter': start_letter, 'min_length': min_length}
+                    break
+            else:
+                RETRIES.inc(result='no_prompt')
+                await safe_send_message(LOG_CHAT_ID, f"Could not find recent prompt for retry in chat {chat_id}", level=logging.WARNING)
+                return
+        except Exception as e:
+            RETRIES.inc(result='no_prompt')
+            await safe_send_message(LOG_CHAT_ID, f"Error fetching prompt for retry in chat {chat_id}: {e}", level=logging.ERROR)
+            return
+    
+    start_letter = last_prompt[chat_id]['start_letter']
+    min_length = last_prompt[chat_id]['min_length']
+    
+    started = time.monotonic()
+    try:
+        await client.send_chat_action(chat_id, ChatAction.TYPING)
+    except Exception as e:
+        await safe_send_message(LOG_CHAT_ID, f"Error sending retry typing action to {chat_id}: {e}", level=logging.WARNING)
+    await typing_floor(started)
+    
+    await used_words.load(chat_id)
+    selected_word = pop_speculative(chat_id, 'retry', start_letter, min_length)
+    if selected_word is None:
+        candidates = await select_retry_words(start_letter, min_length, chat_id)
+        selected_word = candidates[0] if candidates else None
+    if selected_word:
+        commit_turn(chat_id)
+        used_words[chat_id].add(selected_word.lower())
+        save_config(words_record(chat_id, [selected_word.lower()]))
+        log_message = f"Sent retry word (NLTK, after '{invalid_word}' rejected as {rejection_reason}): {selected_word} (length={len(selected_word)}) to chat {chat_id} ({enabled_chats[chat_id]['name']})"
+        await safe_send_message(LOG_CHAT_ID, log_message)
+        if await safe_send_message(chat_id, selected_word[0].upper() + selected_word[1:].lower(), disable_notification=True):
+            RETRIES.inc(result='sent')
+            WORDS_SENT.inc(source='nltk')
+        else:
+            RETRIES.inc(result='send_failed')
+    else:
+        RETRIES.inc(result='no_word')
+        await safe_send_message(LOG_CHAT_ID, f"No valid NLTK word found for '{start_letter}' with min length {min_length} in chat {chat_id} ({enabled_chats[chat_id]['name']})", level=logging.WARNING)
+
+# Function to remember the newest message seen in a chat, and its latest prompt, so a restart resumes from there
+def note_progress(chat_id: int, message_id: int, prompt: Optional[Dict[str, any]] = None):
+    info = enabled_chats.get(chat_id)
+    if info is None:
+        return
+    changes = {}
+    if message_id > info.get('last_message_id', 0):
+        changes['last_message_id'] = message_id
+    if prompt is not None:
+        changes['last_prompt'] = prompt
+    if changes:
+        info.update(changes)
+        save_config(update_record(chat_id, changes))
+
+# Function to extract the words a history message shows as played
+def history_words(message) -> List[str]:
+    if message.from_user and message.from_user.id == GAME_BOT_ID:
+        match = VERDICT_PATTERN.match(WHITESPACE.sub(' ', NON_LETTERS.sub('', message.text).strip()))
+        return [match.group(1).lower()] if match and not match.group('invalid') else []
+    return NON_LETTERS.sub('', message.text).lower().split()
+
+# Function to page through chat history back to the last message seen or the start of the current game, and bulk-add the words played since
+async def backfill_chat(chat_id: int):
+    """
+    Reads newest first, one page of 100 per BACKFILL_PAGE_DELAY seconds, and restores last_prompt from the newest
+    prompt found. The game bot announces no game start we could match, so the current game is taken to begin
+    after the first BACKFILL_GAME_GAP seconds of game bot silence; words from earlier games are left alone.
+    Reads at most BACKFILL_LIMIT messages, or BACKFILL_NEW_CHAT_LIMIT for a chat never seen before.
+    Backfills run one chat at a time.
+    """
+    async with backfill_lock:
+        since_id = enabled_chats[chat_id].get('last_message_id', 0)
+        limit = BACKFILL_LIMIT if since_id else BACKFILL_NEW_CHAT_LIMIT
+        await used_words.load(chat_id)
+        newest_id = since_id
+        offset_id = 0
+        scanned = added = 0
+        prompt = None
+        game_seen_at = time.time()  # Date of the last game bot message seen, walking back from now
+        done = False
+        while not done and scanned < limit:
+            page_size = min(100, limit - scanned)
+            try:
+                page = [msg async for msg in app.get_chat_history(chat_id, limit=page_size, offset_id=offset_id)]
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+                continue
+            new_words = []
+            chat_words = used_words[chat_id]
+            for msg in page:
+                if msg.id <= since_id:
+                    done = True
+                    break
+                if getattr(msg, 'date', None):
+                    if game_seen_at - msg.date.timestamp() > BACKFILL_GAME_GAP:
+                        done = True  # Sent before the current game started
+                        break
+                    if msg.from_user and msg.from_user.id == GAME_BOT_ID:
+                        game_seen_at = msg.date.timestamp()
+                scanned += 1
+                newest_id = max(newest_id, msg.id)
+                if not msg.text:
+                    continue
+                if prompt is None:
+                    prompt_match = PROMPT_PATTERN.match(msg.text)
+                    if prompt_match:
+                        prompt = {'start_letter': prompt_match.group(1), 'min_length': int(prompt_match.group(2)), 'message_id': msg.id}
+                        continue
+                new_words += [word for word in history_words(msg) if word not in chat_words]
+            if new_words:
+                new_words = list(dict.fromkeys(new_words))
+                chat_words.update(new_words)
+                invalidate_speculation(chat_id, new_words)
+                save_config(words_record(chat_id, new_words))
+                added += len(new_words)
+            if len(page) < page_size:
+                break
+            offset_id = page[-1].id
+            await asyncio.sleep(BACKFILL_PAGE_DELAY)
+        
+        if prompt and last_prompt.get(chat_id, {}).get('message_id', 0) < prompt['message_id']:
+            last_prompt[chat_id] = prompt
+            note_progress(chat_id, newest_id, prompt)
+        else:
+            note_progress(chat_id, newest_id)
+        await safe_send_message(LOG_CHAT_ID, f"Backfilled chat {chat_id} ({enabled_chats[chat_id]['name']}): scanned {scanned} messages, added {added} used words" + (f", last prompt {prompt['start_letter']} {prompt['min_length']}+" if prompt else ""))
+
+# Function to start a chat's history backfill unless one is already running
+def start_backfill(chat_id: int):
+    if chat_id in backfills and not backfills[chat_id].done():
+        return
+    task = asyncio.create_task(backfill_chat(chat_id))
+    backfills[chat_id] = task
+    task.add_done_callback(lambda task: report_backfill(chat_id, task))
+
+def report_backfill(chat_id: int, task: asyncio.Task):
+    if backfills.get(chat_id) is task:
+        del backfills[chat_id]
+    if not task.cancelled() and task.exception() is not None:
+        log_digest.add(f"Backfill failed for chat {chat_id}: {task.exception()}", logging.ERROR)
+
+# Function to stop a chat's history backfill
+def cancel_backfill(chat_id: int):
+    task = backfills.pop(chat_id, None)
+    if task:
+        task.cancel()
 
 # Game message handler
 @app.on_message(filters.text & filters.group)
@@ -334,117 +790,48 @@ async def handle_game_message(client, message):
     chat_id = message.chat.id
     if chat_id not in enabled_chats:
         return
+    await used_words.load(chat_id)
     
-    # Pattern for game prompt
-    prompt_pattern = r"Turn: X @ja \(Next: .+?\)\nYour word must start with (\w) and include at least (\d+) letters\."
-    # Pattern for invalid word reply
-    invalid_pattern = r"^(\w+) is not in my list of words$"
-    # Pattern for accepted word reply
-    accepted_pattern = r"^(\w+) is accepted$"
-    # Pattern for word already used
-    used_pattern = r"^(\w+) has been used$"
+    kind, match = classify_message(message, chat_id)
+    if kind == MESSAGE_CHATTER:
+        ingest_words(chat_id, message.text)
+        note_progress(chat_id, message.id)
     
-    # Clean message text and add words to used_words
-    if message.text:
-        cleaned_text = re.sub(r'[^a-zA-Z\s]', '', message.text).strip()
-        word_list = cleaned_text.split()  # Fix naming conflict
-        for word in word_list:
-            if word and word.lower() not in used_words.get(chat_id, set()):
-                used_words[chat_id].add(word.lower())
-                await save_config()
-                print(LOG_CHAT_ID, f"Added word '{word}' to used_words in chat {chat_id} ({enabled_chats[chat_id]['name']})")
-    
-    if message.text and re.match(prompt_pattern, message.text, re.MULTILINE):
-        match = re.match(prompt_pattern, message.text, re.MULTILINE)
+    elif kind == MESSAGE_PROMPT:
         start_letter = match.group(1)
         min_length = int(match.group(2))
-        case = enabled_chats[chat_id]['case']
-        
-        last_prompt[chat_id] = {'start_letter': start_letter, 'min_length': min_length}
-        
-        try:
-            await client.send_chat_action(chat_id, ChatAction.TYPING)
-            await asyncio.sleep(1.5)
-        except Exception as e:
-            await safe_send_message(LOG_CHAT_ID, f"Error sending typing action to {chat_id}: {e}")
-        
-        word = await get_game_word(start_letter, min_length, chat_id, case)
-        if word:
-            await safe_send_message(chat_id, word, disable_notification=True)
-        else:
-            await safe_send_message(LOG_CHAT_ID, f"No valid word found for prompt in chat {chat_id}. Consider clearing used words with /clear.")
+        last_prompt[chat_id] = {'start_letter': start_letter, 'min_length': min_length, 'message_id': message.id}
+        note_progress(chat_id, message.id, last_prompt[chat_id])
+        PROMPTS.inc()
+        start_turn(chat_id, answer_prompt(client, chat_id, start_letter, min_length, enabled_chats[chat_id]['case'], time.monotonic()))
     
-    elif message.reply_to_message and message.reply_to_message.id == last_bot_message_id.get(chat_id) and message.from_user.id == GAME_BOT_ID:
-        cleaned_text = re.sub(r'[^a-zA-Z\s]', '', message.text).strip()
-        cleaned_text = re.sub(r'\s+', ' ', cleaned_text)
-        
-        invalid_match = re.match(invalid_pattern, cleaned_text)
-        accepted_match = re.match(accepted_pattern, cleaned_text)
-        used_match = re.match(used_pattern, cleaned_text)
-        
-        if accepted_match:
-            accepted_word = accepted_match.group(1)
+    elif kind == MESSAGE_VERDICT:
+        note_progress(chat_id, message.id)
+        if match.group('accepted'):
+            accepted_word = match.group(1)
             if accepted_word.lower() not in used_words.get(chat_id, set()):
                 used_words[chat_id].add(accepted_word.lower())
-                await save_config()
+                invalidate_speculation(chat_id, [accepted_word.lower()])
+                save_config(words_record(chat_id, [accepted_word.lower()]))
                 await safe_send_message(LOG_CHAT_ID, f"Word '{accepted_word}' accepted in chat {chat_id} ({enabled_chats[chat_id]['name']})")
             else:
-                await safe_send_message(LOG_CHAT_ID, f"Warning: Accepted word '{accepted_word}' was already in used_words for chat {chat_id} ({enabled_chats[chat_id]['name']})")
+                await safe_send_message(LOG_CHAT_ID, f"Warning: Accepted word '{accepted_word}' was already in used_words for chat {chat_id} ({enabled_chats[chat_id]['name']})", level=logging.WARNING)
         
-        elif invalid_match or used_match:
-            invalid_word = invalid_match.group(1) if invalid_match else used_match.group(1)
-            rejection_reason = "not in list" if invalid_match else "already used"
+        else:
+            invalid_word = match.group(1)
+            rejection_reason = "not in list" if match.group('invalid') else "already used"
+            REJECTIONS.inc(reason=rejection_reason)
             await log_rejected_word(chat_id, invalid_word, rejection_reason)  # Log to rejections.txt
+            if match.group('invalid') and rejection_filter.add(invalid_word):
+                for speculative_chat_id in list(speculative):
+                    invalidate_speculation(speculative_chat_id, [invalid_word.lower()])
+            if turn_pending(chat_id):
+                # A newer prompt is already being answered; retrying the old one would only send a stale word
+                RETRIES.inc(result='stale')
+                await safe_send_message(LOG_CHAT_ID, f"Word '{invalid_word}' rejected ({rejection_reason}) in chat {chat_id} ({enabled_chats[chat_id]['name']}), not retrying: a newer prompt is being answered")
+                return
             await safe_send_message(LOG_CHAT_ID, f"Word '{invalid_word}' rejected ({rejection_reason}) in chat {chat_id} ({enabled_chats[chat_id]['name']}). Retrying with NLTK...")
-            
-            if chat_id not in last_prompt:
-                await safe_send_message(LOG_CHAT_ID, f"No prompt data available for retry in chat {chat_id}. Scanning chat history...")
-                try:
-                    async for msg in app.get_chat_history(chat_id, limit=20):
-                        if msg.text and re.match(prompt_pattern, msg.text, re.MULTILINE):
-                            match = re.match(prompt_pattern, msg.text, re.MULTILINE)
-                            start_letter = match.group(1)
-                            min_length = int(match.group(2))
-                            last_prompt[chat_id] = {'start_letter': start_letter, 'min_length': min_length}
-                            break
-                    else:
-                        await safe_send_message(LOG_CHAT_ID, f"Could not find recent prompt for retry in chat {chat_id}")
-                        return
-                except Exception as e:
-                    await safe_send_message(LOG_CHAT_ID, f"Error fetching prompt for retry in chat {chat_id}: {e}")
-                    return
-            
-            start_letter = last_prompt[chat_id]['start_letter']
-            min_length = last_prompt[chat_id]['min_length']
-            
-            try:
-                await client.send_chat_action(chat_id, ChatAction.TYPING)
-                await asyncio.sleep(1.5)
-            except Exception as e:
-                await safe_send_message(LOG_CHAT_ID, f"Error sending retry typing action to {chat_id}: {e}")
-            
-            nltk_word_set = set(words.words())
-            nltk_matching_words = [
-                word for word in nltk_word_set
-                if len(word) >= min_length
-                and word.lower().startswith(start_letter.lower())
-                and re.match(r'^[a-zA-Z]+$', word)
-                and word.lower() not in used_words[chat_id]
-            ]
-            
-            if nltk_matching_words:
-                nltk_matching_words.sort()
-                selected_word = nltk_matching_words[0]
-                if len(selected_word) >= min_length:
-                    used_words[chat_id].add(selected_word.lower())
-                    await save_config()
-                    log_message = f"Sent retry word (NLTK, after '{invalid_word}' rejected as {rejection_reason}): {selected_word} (length={len(selected_word)}) to chat {chat_id} ({enabled_chats[chat_id]['name']})"
-                    await safe_send_message(LOG_CHAT_ID, log_message)
-                    await safe_send_message(chat_id, selected_word[0].upper() + selected_word[1:].lower(), disable_notification=True)
-                else:
-                    await safe_send_message(LOG_CHAT_ID, f"Selected NLTK word {selected_word} (length={len(selected_word)}) does not meet min_length {min_length} for retry in chat {chat_id}")
-            else:
-                await safe_send_message(LOG_CHAT_ID, f"No valid NLTK word found for '{start_letter}' with min length {min_length} in chat {chat_id} ({enabled_chats[chat_id]['name']})")
+            start_turn(chat_id, answer_rejection(client, chat_id, invalid_word, rejection_reason))
 
 # Startup handler using raw update
 @app.on_raw_update()
@@ -452,12 +839,27 @@ async def on_startup(client, update, users, chats):
     global INITIALIZED
     if not INITIALIZED:
         try:
+            await load_identity(client)  # Before any chat is enabled, so no prompt is missed
             await load_config()
+            state_manager.start()
+            for chat_id in enabled_chats:
+                start_backfill(chat_id)  # Catch up on words played while the bot was down
+            if SHARD_COUNT > 1:
+                background_tasks.add(asyncio.create_task(run_forwarded_commands()))
             await safe_send_message(LOG_CHAT_ID, "Bot started successfully")
             INITIALIZED = True
         except Exception as e:
             print(f"Failed to initialize bot: {e}")
-            await safe_send_message(LOG_CHAT_ID, f"Failed to initialize bot: {e}")
+            await safe_send_message(LOG_CHAT_ID, f"Failed to initialize bot: {e}", level=logging.ERROR)
+
+# Function to run the client until it is stopped, sending the buffered log digest while still connected
+async def run_bot():
+    await app.start()
+    await idle()
+    log_digest.flush()
+    await send_scheduler.drain()
+    await send_scheduler.stop()
+    await app.stop()
 
 def main() -> None:
     """Run bot."""
@@ -469,6 +871,11 @@ if __name__ == "__main__":
     flask_thread.start()
 
     print("Bot is running...")
-    app.run()  # Replaced hax.start() with app.run()
+    try:
+        app.run(run_bot())  # Replaced hax.start() with app.run()
+    finally:
+        # Flush pending chat config on shutdown, also after a crash or a failed login
+        asyncio.get_event_loop().run_until_complete(state_manager.stop())
+        selection_pool.shutdown()
     print("Bot started")  # Replaced LOGGER.info("Bot started") with print
     main()
@@ -0,0 +1,295 @@
+"""
+Offline replay benchmark: a stand-in Pyrogram client and a simulated game bot drive handle_game_message
+across many concurrent chats, and each configuration reports throughput, latency percentiles, memory
+and disk bytes written.
+
+    python -m shivu.benchmark --chats 20 --turns 30 --config SELECTION_POOL=thread --config SELECTION_POOL=process,STORAGE_BACKEND=sqlite
+
+Every configuration runs in its own process and working directory, since the bot reads its settings
+from the environment at import time.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+STATE_FILE_PREFIXES = ("chat_config.json", "chat_state.db")
+BENCHMARK_NAME = "Bench Player"  # Identity of the stand-in session, whose turns the game prompts announce
+BENCHMARK_USERNAME = "bench_player"
+# Settings every configuration starts from. The typing delay and send pacing are off so the bot's own
+# work dominates the numbers; pass TYPING_DELAY=1.5,SEND_RATE=20 to measure the production settings.
+BENCHMARK_ENV = {
+    "API_ID": "1",
+    "API_HASH": "benchmark",
+    "SESSION_STRING": "",
+    "LOG_CHAT_ID": "-1",
+    "TYPING_DELAY": "0",
+    "SEND_RATE": "10000",
+    "SEND_BURST": "1000",
+}
+
+
+class FakeClient:
+    """Stands in for the Pyrogram Client: collects outgoing messages and hands game chat answers to the game bot."""
+
+    def __init__(self, game: "SimulatedGame", send_delay: float):
+        self.game = game
+        self.send_delay = send_delay
+        self.message_ids = itertools.count(1)
+        self.sent = 0
+
+    async def send_chat_action(self, chat_id, action):
+        pass
+
+    async def get_me(self):
+        return SimpleNamespace(first_name=BENCHMARK_NAME, last_name=None, username=BENCHMARK_USERNAME)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.send_delay)
+        self.sent += 1
+        message = SimpleNamespace(id=next(self.message_ids), chat=SimpleNamespace(id=chat_id), text=text)
+        self.game.on_answer(chat_id, message)
+        return message
+
+    async def get_chat_history(self, chat_id, limit=0, offset_id=0):
+        """Newest first, older than offset_id when given, like Pyrogram."""
+        messages = [message for message in reversed(self.game.history.get(chat_id, [])) if not offset_id or message.id < offset_id]
+        for message in messages[:limit or None]:
+            yield message
+
+
+class SimulatedGame:
+    """
+    Plays the game bot in every chat: posts a prompt, waits for the answer, replies with a verdict,
+    and waits for the retry after a rejection. A fixed share of words is treated as missing from
+    the game's list, and other players occasionally chat words into the game.
+    """
+
+    def __init__(self, bot, chats: int, turns: int, reject_percent: int, chatter_percent: int, answer_timeout: float,
+                 reply_delay: float, seed: int):
+        self.bot = bot
+        self.reply_delay = reply_delay
+        self.chat_ids = [-100_000 - i for i in range(chats)]
+        self.turns = turns
+        self.reject_percent = reject_percent
+        self.chatter_percent = chatter_percent
+        self.answer_timeout = answer_timeout
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1_000_000)
+        self.waiting: Dict[int, asyncio.Future] = {}
+        self.used: Dict[int, set] = {chat_id: set() for chat_id in self.chat_ids}
+        self.history: Dict[int, list] = {chat_id: [] for chat_id in self.chat_ids}
+        self.latencies: List[float] = []
+        self.counts = {'prompts': 0, 'answers': 0, 'accepted': 0, 'not_in_list': 0, 'already_used': 0, 'retries': 0, 'unanswered': 0}
+        letters = sorted(set(bot.vocabulary.lengths) & set('abcdefghijklmnopqrstuvwxyz'))
+        self.letters = letters
+        self.chatter_words = [bot.vocabulary.words[i] for i in range(min(len(bot.vocabulary.words), 20000))]
+
+    def in_list(self, word: str) -> bool:
+        return self.bot.word_index.id_of(word) is not None and zlib.crc32(word.encode()) % 100 >= self.reject_percent
+
+    def on_answer(self, chat_id: int, message):
+        future = self.waiting.get(chat_id)
+        if future is not None and not future.done():
+            # The game bot replies a moment later, as it does for real; by then the bot has recorded its message ID
+            asyncio.get_running_loop().call_later(self.reply_delay, lambda: future.done() or future.set_result(message))
+
+    def message(self, chat_id: int, text: str, from_id: int, reply_to=None):
+        message = SimpleNamespace(id=next(self.message_ids), chat=SimpleNamespace(id=chat_id), text=text,
+                                  from_user=SimpleNamespace(id=from_id), reply_to_message=reply_to)
+        self.history[chat_id].append(message)
+        return message
+
+    async def answer(self, chat_id: int, message) -> Optional[Any]:
+        """Deliver a message to the bot and wait for the answer it triggers."""
+        future = self.waiting[chat_id] = asyncio.get_running_loop().create_future()
+        sent = time.perf_counter()
+        await self.bot.handle_game_message(self.bot.app, message)
+        try:
+            answer = await asyncio.wait_for(future, self.answer_timeout)
+        except asyncio.TimeoutError:
+            self.counts['unanswered'] += 1
+            return None
+        self.latencies.append(time.perf_counter() - sent)
+        self.counts['answers'] += 1
+        return answer
+
+    async def verdict(self, chat_id: int, answer) -> bool:
+        """Reply to an answer like the game bot does; True if it was accepted."""
+        word = answer.text.strip()
+        lower = word.lower()
+        if lower in self.used[chat_id]:
+            self.counts['already_used'] += 1
+            text = f"{word} has been used."
+        elif not self.in_list(lower):
+            self.counts['not_in_list'] += 1
+            text = f"{word} is not in my list of words."
+        else:
+            self.counts['accepted'] += 1
+            self.used[chat_id].add(lower)
+            text = f"{word} is accepted."
+        reply = self.message(chat_id, text, self.bot.GAME_BOT_ID, reply_to=answer)
+        if text.endswith("is accepted."):
+            await self.bot.handle_game_message(self.bot.app, reply)
+            return True
+        self.counts['retries'] += 1
+        retry = await self.answer(chat_id, reply)
+        if retry is not None:
+            await self.verdict(chat_id, retry)
+        return False
+
+    async def play_chat(self, chat_id: int):
+        for _ in range(self.turns):
+            if self.random.randrange(100) < self.chatter_percent:
+                word = self.random.choice(self.chatter_words)
+                self.used[chat_id].add(word)
+                await self.bot.handle_game_message(self.bot.app, self.message(chat_id, word.capitalize(), 1))
+            letter = self.random.choice(self.letters)
+            min_length = self.random.randint(3, 8)
+            prompt = self.message(chat_id, f"Turn: {BENCHMARK_NAME} @{BENCHMARK_USERNAME} (Next: Y)\nYour word must start with {letter.upper()} and include at least {min_length} letters.", self.bot.GAME_BOT_ID)
+            self.counts['prompts'] += 1
+            answer = await self.answer(chat_id, prompt)
+            if answer is not None:
+                await self.verdict(chat_id, answer)
+
+    async def run(self):
+        await asyncio.gather(*(self.play_chat(chat_id) for chat_id in self.chat_ids))
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def state_bytes_on_disk(directory: str) -> int:
+    """Size of the chat state files, leaving out the archived lexicon word list written once at startup."""
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if name.startswith(STATE_FILE_PREFIXES) and '.words.' not in name and os.path.isfile(os.path.join(directory, name)))
+
+
+def state_bytes_written(bot) -> Optional[int]:
+    """Bytes the flushes wrote, or None if records were flushed to a backend that cannot tell (SQLite)."""
+    if bot.STATE_FLUSH_RECORDS.values and not bot.STATE_FLUSH_BYTES.values:
+        return None
+    return int(sum(bot.STATE_FLUSH_BYTES.values.values()))
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    import shivu.__main__ as bot
+    from shivu.storage import enable_record
+
+    game = SimulatedGame(bot, args.chats, args.turns, args.reject_percent, args.chatter_percent, args.answer_timeout, args.reply_delay, args.seed)
+    bot.app = FakeClient(game, args.send_delay)  # send_scheduler sends through the module-level app
+    await bot.load_identity(bot.app)
+    await bot.load_config()
+    bot.state_manager.start()
+    for chat_id in game.chat_ids:
+        info = {"alias": bot.generate_alias(), "name": f"bench {chat_id}", "case": args.case}
+        bot.enabled_chats[chat_id] = info
+        bot.used_words[chat_id] = bot.UsedWordSet(bot.word_index)
+        bot.save_config(enable_record(chat_id, info))
+
+    started = time.perf_counter()
+    await game.run()
+    elapsed = time.perf_counter() - started
+    bot.log_digest.flush()
+    await bot.send_scheduler.drain()
+    await bot.send_scheduler.stop()
+    await bot.state_manager.stop()
+    bot.selection_pool.shutdown()
+
+    return {
+        'config': args.label,
+        'chats': args.chats,
+        'turns': args.turns,
+        'seconds': round(elapsed, 3),
+        'answers_per_second': round(game.counts['answers'] / elapsed, 1) if elapsed else None,
+        'p50_ms': _ms(percentile(game.latencies, 50)),
+        'p95_ms': _ms(percentile(game.latencies, 95)),
+        'p99_ms': _ms(percentile(game.latencies, 99)),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'state_bytes_written': state_bytes_written(bot),
+        'state_bytes_on_disk': state_bytes_on_disk(os.getcwd()),
+        'messages_sent': bot.app.sent,
+        **game.counts,
+        'rejection_filter_saved': dict(bot.rejection_filter.saved),
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def run_configuration(config: str, args) -> Dict[str, Any]:
+    """Run one configuration (comma separated NAME=value environment overrides) in a fresh process and directory."""
+    env = dict(os.environ, **BENCHMARK_ENV)
+    env["LEXICON_FILE"] = os.path.abspath(env.get("LEXICON_FILE", "lexicon.bin"))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get("PYTHONPATH")]))
+    for setting in filter(None, config.split(',')):
+        name, _, value = setting.partition('=')
+        env[name.strip()] = value.strip()
+    command = [sys.executable, "-m", "shivu.benchmark", "--run", "--label", config or "default",
+               "--chats", str(args.chats), "--turns", str(args.turns), "--case", args.case,
+               "--reject-percent", str(args.reject_percent), "--chatter-percent", str(args.chatter_percent),
+               "--send-delay", str(args.send_delay), "--reply-delay", str(args.reply_delay), "--answer-timeout", str(args.answer_timeout), "--seed", str(args.seed)]
+    with tempfile.TemporaryDirectory(prefix="shivu-bench-") as directory:
+        result = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Configuration {config!r} failed:\n{result.stderr[-4000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def print_table(results: List[Dict[str, Any]]):
+    columns = ['config', 'answers_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'max_rss_mb', 'state_bytes_written',
+               'state_bytes_on_disk', 'accepted', 'not_in_list', 'already_used', 'unanswered']
+    rows = [['n/a' if result.get(column) is None else str(result.get(column)) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmark with a simulated game bot")
+    parser.add_argument("--config", action="append", help="Comma separated NAME=value environment overrides; repeat to compare configurations")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=30, help="Prompts per chat")
+    parser.add_argument("--case", default="1", choices=["1", "4", "5"])
+    parser.add_argument("--reject-percent", type=int, default=5, help="Share of words missing from the simulated game's list")
+    parser.add_argument("--chatter-percent", type=int, default=20, help="Chance of another player's word before each prompt")
+    parser.add_argument("--send-delay", type=float, default=0.005, help="Simulated Telegram send latency in seconds")
+    parser.add_argument("--reply-delay", type=float, default=0.01, help="Simulated game bot reply delay in seconds")
+    parser.add_argument("--answer-timeout", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines instead of a table")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--label", default="default", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        result = asyncio.run(run_benchmark(args))
+        print(json.dumps(result))
+        return
+
+    results = [run_configuration(config, args) for config in (args.config or [""])]
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+import base64
+import hashlib
+import re
+import zlib
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from shivu import LOGGER
+
+WORDFREQ_LANG = 'en'
+WORDFREQ_SIZE = 321180
+WORD_PATTERN = re.compile(r'^[a-zA-Z]+$')
+HIGH_FREQ = 0.000001  # Words at or above this frequency form the high tier
+
+# Bucket key: (start letter, length, high tier)
+BucketKey = Tuple[str, int, bool]
+# Per-chat bucket positions; every entry before a position is known to be used
+Cursor = Dict[tuple, int]
+
+
+def letter_lengths(keys: Iterable[tuple]) -> Dict[str, List[int]]:
+    """start letter -> available word lengths, ascending, from (letter, length, ...) keys"""
+    lengths: Dict[str, Set[int]] = {}
+    for key in keys:
+        lengths.setdefault(key[0], set()).add(key[1])
+    return {letter: sorted(found) for letter, found in lengths.items()}
+
+
+class Vocabulary:
+    """
+    wordfreq vocabulary indexed once at startup.
+    Word IDs follow selection order (highest frequency first, ties kept in wordfreq rank order),
+    so the best word among several candidates is simply the one with the lowest ID.
+    Every word is listed in its (start, length, tier) bucket, a sequence of IDs in that same order.
+    Sequences may be lists or views into a lexicon file. Other orders are precomputed Strategy rankings.
+    """
+
+    def __init__(self, words: Sequence[str], freqs: Sequence[float], buckets: Optional[Dict[BucketKey, Sequence[int]]] = None,
+                 strategies: Optional[Dict[str, "Strategy"]] = None):
+        self.words = words
+        self.freqs = freqs
+        if buckets is None:
+            buckets = {}
+            for word_id, word in enumerate(words):
+                high = freqs[word_id] >= HIGH_FREQ
+                buckets.setdefault((word[0], len(word), high), []).append(word_id)
+        self.buckets = buckets
+        self.lengths = letter_lengths(self.buckets)
+        if strategies is None:
+            strategies = {name: Strategy.build(name, self, score(self)) for name, score in STRATEGY_SCORES.items()}
+        self.strategies = strategies
+
+    def ranking(self, strategy: Optional[str] = None):
+        """The precomputed strategy ranking with that name, or the vocabulary itself for plain frequency order."""
+        return self if strategy is None else self.strategies[strategy]
+
+    @classmethod
+    def from_wordfreq(cls) -> "Vocabulary":
+        import wordfreq  # Only needed when the lexicon file has to be rebuilt
+        ranked = []
+        for word in wordfreq.top_n_list(WORDFREQ_LANG, WORDFREQ_SIZE):
+            if WORD_PATTERN.match(word):
+                word = word.lower()
+                ranked.append((word, wordfreq.word_frequency(word, WORDFREQ_LANG)))
+        ranked.sort(key=lambda x: x[1], reverse=True)  # Stable: equal frequencies keep wordfreq rank
+        return cls([word for word, _ in ranked], [freq for _, freq in ranked])
+
+    def best(self, start_letter: str, min_length: int, used: Set[str], cursor: Optional[Cursor] = None,
+             skip: Set[int] = frozenset(), exclude: Optional[Set[str]] = None,
+             on_excluded: Optional[Callable[[int], Any]] = None) -> Optional[int]:
+        """
+        Return the ID of the highest frequency word starting with start_letter, at least min_length long,
+        not in used. None if nothing matches. Passing the chat's cursor lets repeated lookups skip used words for good;
+        word IDs in skip are passed over for this lookup only. Words in exclude are ruled out for every chat;
+        exclude may only ever grow, since cursors move past its words like used ones. on_excluded is called
+        with the ID of an excluded word that would otherwise have been returned.
+        """
+        start_letter = start_letter.lower()
+        best_id = None
+        best_excluded = None
+        for length in self.lengths.get(start_letter, []):
+            if length < min_length:
+                continue
+            for high in (True, False):
+                word_id, excluded_id = self._head((start_letter, length, high), used, cursor, best_id, skip, exclude)
+                if word_id is not None:
+                    best_id = word_id
+                if excluded_id is not None and (best_excluded is None or excluded_id < best_excluded):
+                    best_excluded = excluded_id
+        if on_excluded is not None and best_excluded is not None and (best_id is None or best_excluded < best_id):
+            on_excluded(best_excluded)
+        return best_id
+
+    def _head(self, key: BucketKey, used: Set[str], cursor: Optional[Cursor], below: Optional[int],
+              skip: Set[int] = frozenset(), exclude: Optional[Set[str]] = None) -> Tuple[Optional[int], Optional[int]]:
+        """
+        First unused, unskipped, unexcluded word ID in the bucket if it ranks above below,
+        and the first excluded word ID passed over on the way.
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return None, None
+        is_used = self._membership(used)
+        is_excluded = self._membership(exclude) if exclude else None
+        pos = cursor.get(key, 0) if cursor is not None else 0
+        head = None
+        excluded_id = None
+        used_prefix = True  # The cursor moves past used and excluded words, never past skipped ones
+        for i in range(pos, len(bucket)):
+            word_id = bucket[i]
+            if below is not None and word_id > below:
+                break  # Everything further down this bucket ranks lower
+            if is_used(word_id):
+                if used_prefix:
+                    pos = i + 1
+            elif word_id in skip:
+                used_prefix = False
+            elif is_excluded is not None and is_excluded(word_id):
+                if used_prefix:
+                    pos = i + 1
+                if excluded_id is None:
+                    excluded_id = word_id
+            else:
+                head = word_id
+                break
+        if cursor is not None:
+            cursor[key] = pos
+        return head, excluded_id
+
+    def _membership(self, words: Set[str]) -> Callable[[int], bool]:
+        if isinstance(words, UsedWordSet) and words.index.vocabulary is self:
+            return words.has_id  # Bit test, no string hashing
+        return lambda word_id: self.words[word_id] in words
+
+
+class Strategy:
+    """
+    One precomputed score column: the vocabulary ranked by a strategy's score at lexicon build time,
+    ties kept in frequency order. order maps rank to word ID, and buckets hold the ranks of each
+    (start letter, length) in ascending order, so selection is the same head-of-bucket lookup as
+    Vocabulary.best, with ranks in place of IDs.
+    """
+
+    def __init__(self, name: str, vocabulary: "Vocabulary", order: Sequence[int], buckets: Dict[Tuple[str, int], Sequence[int]]):
+        self.name = name
+        self.vocabulary = vocabulary
+        self.order = order
+        self.buckets = buckets
+        self.lengths = letter_lengths(self.buckets)
+
+    @classmethod
+    def build(cls, name: str, vocabulary: "Vocabulary", scores: Sequence[Any]) -> "Strategy":
+        order = sorted(range(len(vocabulary.words)), key=lambda word_id: (scores[word_id], word_id))
+        buckets: Dict[Tuple[str, int], List[int]] = {}
+        for rank, word_id in enumerate(order):
+            word = vocabulary.words[word_id]
+            buckets.setdefault((word[0], len(word)), []).append(rank)
+        return cls(name, vocabulary, order, buckets)
+
+    def best(self, start_letter: str, min_length: int, used: Set[str], cursor: Optional[Cursor] = None,
+             skip: Set[int] = frozenset(), exclude: Optional[Set[str]] = None,
+             on_excluded: Optional[Callable[[int], Any]] = None) -> Optional[int]:
+        """Same contract as Vocabulary.best, returning the ID of the best ranked word for this strategy."""
+        start_letter = start_letter.lower()
+        order = self.order
+        is_used = self.vocabulary._membership(used)
+        is_excluded = self.vocabulary._membership(exclude) if exclude else None
+        best_rank = None
+        best_excluded = None
+        for length in self.lengths.get(start_letter, []):
+            if length < min_length:
+                continue
+            key = (self.name, start_letter, length)  # Cursor keys never clash with Vocabulary bucket keys
+            bucket = self.buckets[(start_letter, length)]
+            pos = cursor.get(key, 0) if cursor is not None else 0
+            used_prefix = True
+            for i in range(pos, len(bucket)):
+                rank = bucket[i]
+                if best_rank is not None and rank > best_rank:
+                    break
+                word_id = order[rank]
+                if is_used(word_id):
+                    if used_prefix:
+                        pos = i + 1
+                elif word_id in skip:
+                    used_prefix = False
+                elif is_excluded is not None and is_excluded(word_id):
+                    if used_prefix:
+                        pos = i + 1
+                    if best_excluded is None or rank < best_excluded:
+                        best_excluded = rank
+                else:
+                    best_rank = rank
+                    break
+            if cursor is not None:
+                cursor[key] = pos
+        if on_excluded is not None and best_excluded is not None and (best_rank is None or best_excluded < best_rank):
+            on_excluded(order[best_excluded])
+        return None if best_rank is None else order[best_rank]
+
+
+# Strategy score columns, computed once per lexicon build: name -> function giving a sort key per word ID, lowest first
+
+def xyz_scores(vocabulary: "Vocabulary") -> List[int]:
+    """
+    Case 4: high tier words ending with x, then z, then y; then any word ending with x, then y, then z;
+    then everything else.
+    """
+    high_rank = {'x': 0, 'z': 1, 'y': 2}
+    any_rank = {'x': 3, 'y': 4, 'z': 5}
+    scores = []
+    for word_id, word in enumerate(vocabulary.words):
+        if vocabulary.freqs[word_id] >= HIGH_FREQ and word[-1] in high_rank:
+            scores.append(high_rank[word[-1]])
+        else:
+            scores.append(any_rank.get(word[-1], 6))
+    return scores
+
+
+def trap_scores(vocabulary: "Vocabulary") -> List[Tuple[bool, float]]:
+    """
+    High tier words first, each tier ordered by how little frequency mass the vocabulary has
+    for words starting with the word's last letter, leaving the next player the fewest common answers.
+    """
+    follow_mass: Dict[str, float] = {}
+    for word_id, word in enumerate(vocabulary.words):
+        follow_mass[word[0]] = follow_mass.get(word[0], 0.0) + vocabulary.freqs[word_id]
+    return [(vocabulary.freqs[word_id] < HIGH_FREQ, follow_mass.get(word[-1], 0.0)) for word_id, word in enumerate(vocabulary.words)]
+
+
+STRATEGY_SCORES: Dict[str, Callable[["Vocabulary"], Sequence[Any]]] = {
+    'xyz': xyz_scores,
+    'trap': trap_scores,
+}
+
+
+class RetryLexicon:
+    """
+    NLTK words corpus loaded once for the rejection retry.
+    Words keep their corpus spelling and are kept in sorted arrays per (start letter, length),
+    so the alphabetically first candidate is the smallest head among the arrays long enough.
+    """
+
+    def __init__(self, arrays: Dict[Tuple[str, int], Sequence[str]]):
+        self.arrays = arrays
+        self.lengths = letter_lengths(self.arrays)
+
+    @classmethod
+    def build(cls, corpus_words: Iterable[str]) -> "RetryLexicon":
+        arrays: Dict[Tuple[str, int], List[str]] = {}
+        for word in set(corpus_words):
+            if WORD_PATTERN.match(word):
+                arrays.setdefault((word[0].lower(), len(word)), []).append(word)
+        for array in arrays.values():
+            array.sort()
+        return cls(arrays)
+
+    @classmethod
+    def from_nltk(cls) -> "RetryLexicon":
+        import nltk  # Only needed when the lexicon file has to be rebuilt
+        # Download NLTK words corpus if not already present
+        try:
+            nltk.data.find('corpora/words')
+        except LookupError:
+            try:
+                nltk.download('words')
+            except Exception as e:
+                print(f"Failed to download NLTK words corpus: {e}")
+        from nltk.corpus import words
+        return cls.build(words.words())
+
+    def first(self, start_letter: str, min_length: int, used: Set[str], skip: Set[str] = frozenset(),
+              exclude: Optional[Set[str]] = None, on_excluded: Optional[Callable[[str], Any]] = None) -> Optional[str]:
+        """
+        Return the alphabetically first word starting with start_letter, at least min_length long,
+        whose lowercase form is not in used, skip or exclude. None if nothing matches.
+        on_excluded is called with an excluded word that would otherwise have been returned.
+        """
+        start_letter = start_letter.lower()
+        best_word = None
+        best_excluded = None
+        for length in self.lengths.get(start_letter, []):
+            if length < min_length:
+                continue
+            for word in self.arrays[(start_letter, length)]:
+                if best_word is not None and word > best_word:
+                    break  # Everything further down this array sorts later
+                lower = word.lower()
+                if lower in used or lower in skip:
+                    continue
+                if exclude and lower in exclude:
+                    if best_excluded is None or word < best_excluded:
+                        best_excluded = word
+                    continue
+                best_word = word
+                break
+        if on_excluded is not None and best_excluded is not None and (best_word is None or best_excluded < best_word):
+            on_excluded(best_excluded)
+        return best_word
+
+
+class WordIndex:
+    """
+    Integer IDs shared by every chat: wordfreq vocabulary IDs first, then lowercase NLTK words not in it.
+    order lists the IDs by word so lookups bisect instead of holding a dict of every word.
+    The fingerprint identifies this exact ID assignment in persisted bitsets.
+    """
+
+    def __init__(self, vocabulary: Vocabulary, words: Sequence[str], order: Sequence[int], fingerprint: str):
+        self.vocabulary = vocabulary
+        self.words = words
+        self.order = order
+        self.fingerprint = fingerprint
+        self._sorted_words = _OrderedView(words, order)
+
+    @classmethod
+    def build(cls, vocabulary: Vocabulary, retry_lexicon: RetryLexicon) -> "WordIndex":
+        words: List[str] = list(vocabulary.words)
+        extra = {word.lower() for array in retry_lexicon.arrays.values() for word in array}
+        words += sorted(extra.difference(words))
+        order = sorted(range(len(words)), key=words.__getitem__)
+        fingerprint = hashlib.sha1('\n'.join(words).encode()).hexdigest()[:16]
+        return cls(vocabulary, words, order, fingerprint)
+
+    def id_of(self, word: str) -> Optional[int]:
+        pos = bisect_left(self._sorted_words, word)
+        if pos < len(self.order) and self._sorted_words[pos] == word:
+            return self.order[pos]
+        return None
+
+
+class _OrderedView:
+    """Read-only sequence of words[order[i]], for bisecting."""
+
+    def __init__(self, words: Sequence[str], order: Sequence[int]):
+        self.words = words
+        self.order = order
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __getitem__(self, pos: int) -> str:
+        return self.words[self.order[pos]]
+
+
+class UsedWordSet:
+    """
+    Set of lowercase words stored as a bitset over WordIndex IDs, plus a small side set for words
+    outside the lexicon. Supports the set operations the bot uses (in, add, update, len, iteration).
+    """
+
+    __slots__ = ('index', 'bits', 'extra', 'count')
+
+    def __init__(self, index: WordIndex, words: Iterable[str] = ()):
+        self.index = index
+        self.bits = bytearray((len(index.words) + 7) // 8)
+        self.extra: Set[str] = set()
+        self.count = 0
+        self.update(words)
+
+    @classmethod
+    def from_data(cls, index: WordIndex, data: Any = (),
+                  previous_words: Optional[Callable[[str], Optional[Sequence[str]]]] = None) -> "UsedWordSet":
+        """
+        Build from another UsedWordSet, a to_state() dict or an iterable of words.
+        A to_state() dict from another lexicon is remapped word by word through previous_words(fingerprint),
+        the word list behind that lexicon's IDs.
+        """
+        if isinstance(data, UsedWordSet) and data.index is index:
+            word_set = cls(index)
+            word_set.bits[:] = data.bits
+            word_set.extra = set(data.extra)
+            word_set.count = data.count
+            return word_set
+        if isinstance(data, dict):
+            word_set = cls(index, data.get('extra', []))
+            if data.get('lexicon') == index.fingerprint:
+                word_set.bits[:] = zlib.decompress(base64.b64decode(data['bits']))
+                word_set.count = len(word_set.extra) + int.from_bytes(word_set.bits, 'little').bit_count()
+                return word_set
+            old_words = previous_words(data.get('lexicon')) if previous_words is not None else None
+            if old_words is not None:
+                word_set.update(old_words[word_id] for word_id in _set_bits(zlib.decompress(base64.b64decode(data['bits']))))
+            else:
+                LOGGER.error(f"Used word bitset built for lexicon {data.get('lexicon')} cannot be read with lexicon {index.fingerprint} "
+                             f"and its word list is missing; keeping only out-of-lexicon words")
+            return word_set
+        return cls(index, data)
+
+    @classmethod
+    def from_bits(cls, index: WordIndex, bits: bytes, extra: Iterable[str] = ()) -> "UsedWordSet":
+        """Build from raw bits over index's IDs and out-of-lexicon words, as copied to selection worker processes."""
+        word_set = cls(index, extra)
+        word_set.bits[:] = bits
+        word_set.count += int.from_bytes(word_set.bits, 'little').bit_count()
+        return word_set
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            'lexicon': self.index.fingerprint,
+            'bits': base64.b64encode(zlib.compress(bytes(self.bits))).decode(),
+            'extra': sorted(self.extra),
+        }
+
+    def has_id(self, word_id: int) -> bool:
+        return self.bits[word_id >> 3] >> (word_id & 7) & 1 == 1
+
+    def __contains__(self, word: str) -> bool:
+        word_id = self.index.id_of(word)
+        if word_id is None:
+            return word in self.extra
+        return self.has_id(word_id)
+
+    def add(self, word: str):
+        word_id = self.index.id_of(word)
+        if word_id is None:
+            if word not in self.extra:
+                self.extra.add(word)
+                self.count += 1
+        elif not self.has_id(word_id):
+            self.bits[word_id >> 3] |= 1 << (word_id & 7)
+            self.count += 1
+
+    def update(self, words: Iterable[str]):
+        for word in words:
+            self.add(word)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        words = self.index.words
+        for word_id in _set_bits(self.bits):
+            yield words[word_id]
+        yield from self.extra
+
+
+def _set_bits(bits: bytes) -> Iterable[int]:
+    """IDs of the set bits, ascending."""
+    for byte_index, byte in enumerate(bits):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield byte_index * 8 + bit
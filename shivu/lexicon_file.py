@@ -0,0 +1,225 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from functools import lru_cache
+from importlib import metadata
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from shivu import LOGGER
+from shivu.lexicon import STRATEGY_SCORES, WORDFREQ_SIZE, RetryLexicon, Strategy, Vocabulary, WordIndex
+
+MAGIC = b'SHIVULEX'
+FORMAT_VERSION = 3
+LEXICON_FILE = "lexicon.bin"
+ALIGN = 8
+
+Lexicon = Tuple[Vocabulary, RetryLexicon, WordIndex]
+
+
+class PackedStrings:
+    """Read-only sequence of ASCII strings stored back to back in a blob, with uint32 offsets (one extra at the end)."""
+
+    def __init__(self, blob: memoryview, offsets: Sequence[int], start: int = 0, stop: Optional[int] = None):
+        self.blob = blob
+        self.offsets = offsets
+        self.start = start
+        self.stop = len(offsets) - 1 if stop is None else stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < self.stop - self.start:
+            raise IndexError(i)
+        i += self.start
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], 'ascii')
+
+    def __iter__(self):
+        for i in range(self.stop - self.start):
+            yield self[i]
+
+    def slice(self, start: int, stop: int) -> "PackedStrings":
+        return PackedStrings(self.blob, self.offsets, self.start + start, self.start + stop)
+
+
+def source_versions() -> Dict[str, Any]:
+    """What the lexicon was compiled from; a file built from anything else is stale."""
+    versions: Dict[str, Any] = {'format': FORMAT_VERSION, 'byteorder': sys.byteorder, 'wordfreq_size': WORDFREQ_SIZE,
+                                'strategies': sorted(STRATEGY_SCORES)}
+    for package in ('wordfreq', 'nltk'):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def _pack(words: Sequence[str]) -> Tuple[bytes, array]:
+    offsets = array('I', [0])
+    parts = []
+    for word in words:
+        encoded = word.encode('ascii')
+        parts.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+    return b''.join(parts), offsets
+
+
+def write_lexicon_file(path: str, lexicon: Lexicon):
+    vocabulary, retry_lexicon, word_index = lexicon
+    words_blob, word_offsets = _pack(word_index.words)
+
+    bucket_table: List[List[Any]] = []
+    bucket_ids = array('I')
+    for (letter, length, high), bucket in sorted(vocabulary.buckets.items()):
+        bucket_table.append([letter, length, int(high), len(bucket_ids), len(bucket_ids) + len(bucket)])
+        bucket_ids.extend(bucket)
+
+    retry_table: List[List[Any]] = []
+    retry_words: List[str] = []
+    for (letter, length), words in sorted(retry_lexicon.arrays.items()):
+        retry_table.append([letter, length, len(retry_words), len(retry_words) + len(words)])
+        retry_words.extend(words)
+    retry_blob, retry_offsets = _pack(retry_words)
+
+    strategy_tables: Dict[str, List[List[Any]]] = {}
+    strategy_sections = []
+    for name, strategy in sorted(vocabulary.strategies.items()):
+        table: List[List[Any]] = []
+        ranks = array('I')
+        for (letter, length), bucket in sorted(strategy.buckets.items()):
+            table.append([letter, length, len(ranks), len(ranks) + len(bucket)])
+            ranks.extend(bucket)
+        strategy_tables[name] = table
+        strategy_sections += [(f'strategy_{name}_order', array('I', strategy.order).tobytes()), (f'strategy_{name}_ranks', ranks.tobytes())]
+
+    sections = [
+        ('words', words_blob),
+        ('word_offsets', word_offsets.tobytes()),
+        ('freqs', array('f', vocabulary.freqs).tobytes()),
+        ('order', array('I', word_index.order).tobytes()),
+        ('bucket_ids', bucket_ids.tobytes()),
+        ('retry_words', retry_blob),
+        ('retry_offsets', retry_offsets.tobytes()),
+    ] + strategy_sections
+    section_table = {}
+    offset = 0
+    for name, data in sections:
+        section_table[name] = [offset, len(data)]
+        offset += len(data) + -len(data) % ALIGN
+    header = json.dumps({
+        'versions': source_versions(),
+        'fingerprint': word_index.fingerprint,
+        'vocabulary_size': len(vocabulary.words),
+        'sections': section_table,
+        'buckets': bucket_table,
+        'retry': retry_table,
+        'strategies': strategy_tables,
+    }).encode()
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        prefix = MAGIC + struct.pack('<I', len(header)) + header
+        f.write(prefix + b'\0' * (-len(prefix) % ALIGN))
+        for _, data in sections:
+            f.write(data + b'\0' * (-len(data) % ALIGN))
+    os.replace(tmp_path, path)
+
+
+def open_lexicon_file(path: str) -> Lexicon:
+    """Memory-map a lexicon file. Raises OSError if it is missing and ValueError if it is unreadable or stale."""
+    with open(path, 'rb') as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f"{path} is not a lexicon file")
+    header_size, = struct.unpack('<I', view[len(MAGIC):len(MAGIC) + 4])
+    header_end = len(MAGIC) + 4 + header_size
+    header = json.loads(bytes(view[len(MAGIC) + 4:header_end]))
+    if header['versions'] != source_versions():
+        raise ValueError(f"{path} was built from {header['versions']}, current sources are {source_versions()}")
+    base = header_end + -header_end % ALIGN
+
+    def section(name: str, typecode: Optional[str] = None) -> memoryview:
+        offset, size = header['sections'][name]
+        data = view[base + offset:base + offset + size]
+        return data.cast(typecode) if typecode else data
+
+    words = PackedStrings(section('words'), section('word_offsets', 'I'))
+    bucket_ids = section('bucket_ids', 'I')
+    buckets = {
+        (letter, length, bool(high)): bucket_ids[start:stop]
+        for letter, length, high, start, stop in header['buckets']
+    }
+    vocabulary = Vocabulary(words.slice(0, header['vocabulary_size']), section('freqs', 'f'), buckets, strategies={})
+    for name, table in header['strategies'].items():
+        ranks = section(f'strategy_{name}_ranks', 'I')
+        strategy_buckets = {(letter, length): ranks[start:stop] for letter, length, start, stop in table}
+        vocabulary.strategies[name] = Strategy(name, vocabulary, section(f'strategy_{name}_order', 'I'), strategy_buckets)
+
+    retry_words = PackedStrings(section('retry_words'), section('retry_offsets', 'I'))
+    retry_lexicon = RetryLexicon({(letter, length): retry_words.slice(start, stop) for letter, length, start, stop in header['retry']})
+
+    word_index = WordIndex(vocabulary, words, section('order', 'I'), header['fingerprint'])
+    return vocabulary, retry_lexicon, word_index
+
+
+def build_lexicon() -> Lexicon:
+    vocabulary = Vocabulary.from_wordfreq()
+    retry_lexicon = RetryLexicon.from_nltk()
+    return vocabulary, retry_lexicon, WordIndex.build(vocabulary, retry_lexicon)
+
+
+def load_lexicon(path: str = LEXICON_FILE) -> Lexicon:
+    """Map the compiled lexicon, rebuilding it from wordfreq and NLTK first if it is missing or stale."""
+    try:
+        return open_lexicon_file(path)
+    except (OSError, ValueError, KeyError) as e:
+        LOGGER.info(f"Rebuilding lexicon file {path}: {e}")
+    lexicon = build_lexicon()
+    try:
+        write_lexicon_file(path, lexicon)
+        return open_lexicon_file(path)
+    except (OSError, ValueError) as e:
+        LOGGER.warning(f"Could not write lexicon file {path}, using the in-memory lexicon: {e}")
+        return lexicon
+
+
+def word_list_path(prefix: str, fingerprint: str) -> str:
+    return f"{prefix}.words.{fingerprint}"
+
+
+def archive_word_list(prefix: str, word_index: WordIndex):
+    """
+    Keep the word list behind word_index's IDs next to state persisted as bitsets over them, once per lexicon,
+    so those bitsets can still be read after wordfreq or NLTK updates change the lexicon.
+    """
+    path = word_list_path(prefix, word_index.fingerprint)
+    if os.path.exists(path):
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(zlib.compress('\n'.join(word_index.words).encode('ascii')))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+@lru_cache(maxsize=4)
+def archived_word_list(prefix: str, fingerprint: str) -> Optional[List[str]]:
+    """Word list archived for a lexicon fingerprint, or None if there is none."""
+    try:
+        with open(word_list_path(prefix, fingerprint), 'rb') as f:
+            return zlib.decompress(f.read()).decode('ascii').split('\n')
+    except (OSError, zlib.error, UnicodeDecodeError) as e:
+        LOGGER.warning(f"No readable word list for lexicon {fingerprint}: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    # Offline build step: python -m shivu.lexicon_file [path]
+    target = sys.argv[1] if len(sys.argv) > 1 else LEXICON_FILE
+    write_lexicon_file(target, build_lexicon())
+    print(f"Wrote {target} ({os.path.getsize(target)} bytes)")
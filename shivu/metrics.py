@@ -0,0 +1,141 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Default histogram buckets in seconds, from sub-millisecond selection up to multi-second turns
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, registry: "Registry", name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.lock = registry.lock
+        registry.metrics.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, registry: "Registry", name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(registry, name, help_text, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in sorted(self.values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry: "Registry", name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.values: Dict[Labels, List[float]] = {}  # labels -> bucket counts, then sum
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, counts in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {counts[-2]}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """Gauge or counter whose values are read from live state at scrape time: collect() -> {label values: value}."""
+
+    def __init__(self, registry: "Registry", name: str, help_text: str, collect: Callable[[], Dict[Labels, float]],
+                 labels: Sequence[str] = (), kind: str = 'gauge'):
+        super().__init__(registry, name, help_text, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in sorted(self.collect().items())]
+
+
+class Registry:
+    """Metrics rendered together in the Prometheus text exposition format. Safe to update from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: List[_Metric] = []
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return Counter(self, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return Histogram(self, name, help_text, labels, buckets)
+
+    def callback(self, name: str, help_text: str, collect: Callable[[], Dict[Labels, float]], labels: Sequence[str] = (),
+                 kind: str = 'gauge') -> CallbackMetric:
+        return CallbackMetric(self, name, help_text, collect, labels, kind)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.header()
+            if isinstance(metric, CallbackMetric):
+                lines += metric.render()  # Reads bot state, outside the lock
+            else:
+                with self.lock:
+                    lines += metric.render()
+        return '\n'.join(lines) + '\n'
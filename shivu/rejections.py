@@ -0,0 +1,59 @@
+import re
+from typing import Dict, Iterable
+
+from shivu import LOGGER
+from shivu.lexicon import UsedWordSet, WordIndex
+
+REJECTIONS_FILE = "rejections.txt"
+# Lines written by log_rejected_word: [timestamp] Chat ID: <id>, Word: <word>, Reason: <reason>
+REJECTION_LINE = re.compile(r'Word: (?P<word>[a-zA-Z]+), Reason: not in list$')
+
+
+class RejectionFilter:
+    """
+    Words the game bot rejected as "not in list" in any chat, kept as a bitset over the shared WordIndex.
+    Selection skips them up front, and the counters record how many retry round-trips that saved.
+    """
+
+    def __init__(self, index: WordIndex, words: Iterable[str] = ()):
+        self.words = UsedWordSet(index, (word.lower() for word in words))
+        self.saved: Dict[str, int] = {'wordfreq': 0, 'nltk': 0}  # selection -> excluded words it would have sent
+        self.added = 0  # Rejections learned since startup
+
+    @classmethod
+    def load(cls, index: WordIndex, path: str = REJECTIONS_FILE) -> "RejectionFilter":
+        words = []
+        try:
+            with open(path) as f:
+                for line in f:
+                    match = REJECTION_LINE.search(line.rstrip('\n'))
+                    if match:
+                        words.append(match.group('word'))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            LOGGER.warning(f"Could not read {path}, starting with an empty rejection filter: {e}")
+        return cls(index, words)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.words
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def add(self, word: str) -> bool:
+        """Add a rejected word; True if it was not filtered yet."""
+        word = word.lower()
+        if word in self.words:
+            return False
+        self.words.add(word)
+        self.added += 1
+        return True
+
+    def record_saved(self, selection: str):
+        """Count a round-trip saved because selection would otherwise have sent a rejected word."""
+        self.saved[selection] += 1
+
+    def summary(self) -> str:
+        return (f"Rejection filter: {len(self)} words ({self.added} learned since startup), "
+                f"saved {self.saved['wordfreq']} wordfreq and {self.saved['nltk']} NLTK round-trips")
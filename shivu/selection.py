@@ -0,0 +1,126 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple
+
+from shivu.lexicon import Cursor, RetryLexicon, UsedWordSet, Vocabulary, WordIndex
+
+# Ranked wordfreq candidate: (word, frequency, log label)
+Candidate = Tuple[str, float, str]
+
+
+def rank_game_words(vocabulary: Vocabulary, strategy: Optional[str], label: str, start_letter: str, min_length: int, used: Set[str],
+                    cursor: Optional[Cursor] = None, exclude: Optional[Set[str]] = None, count: int = 1) -> Tuple[List[Candidate], bool]:
+    """
+    Up to count candidates, best first in the strategy's precomputed ranking (plain frequency order for None).
+    Also returns whether an excluded word would otherwise have been the first candidate.
+    """
+    ranking = vocabulary.ranking(strategy)
+    picked: Set[int] = set()
+    candidates: List[Candidate] = []
+    excluded: List[int] = []
+    while len(candidates) < count:
+        word_id = ranking.best(start_letter, min_length, used, cursor=cursor, skip=picked,
+                               exclude=exclude, on_excluded=None if candidates else excluded.append)
+        if word_id is None:
+            break
+        picked.add(word_id)
+        candidates.append((vocabulary.words[word_id], vocabulary.freqs[word_id], label))
+    return candidates, bool(excluded)
+
+
+def rank_retry_words(retry_lexicon: RetryLexicon, start_letter: str, min_length: int, used: Set[str],
+                     exclude: Optional[Set[str]] = None, count: int = 1) -> Tuple[List[str], bool]:
+    """Up to count NLTK words, alphabetically first unused ones first, and whether an excluded word was passed over for the first."""
+    picked: Set[str] = set()
+    candidates: List[str] = []
+    excluded: List[str] = []
+    while len(candidates) < count:
+        word = retry_lexicon.first(start_letter, min_length, used, skip=picked, exclude=exclude,
+                                   on_excluded=None if candidates else excluded.append)
+        if word is None:
+            break
+        picked.add(word.lower())
+        candidates.append(word)
+    return candidates, bool(excluded)
+
+
+# Lexicon of a worker process, mapped once by _init_worker
+_worker_lexicon: Optional[Tuple[Vocabulary, RetryLexicon, WordIndex]] = None
+
+
+def _init_worker(lexicon_file: str, fingerprint: str):
+    global _worker_lexicon
+    from shivu.lexicon_file import load_lexicon
+    _worker_lexicon = load_lexicon(lexicon_file)
+    if _worker_lexicon[2].fingerprint != fingerprint:
+        raise RuntimeError(f"{lexicon_file} holds lexicon {_worker_lexicon[2].fingerprint}, the bot runs {fingerprint}")
+
+
+def _word_set(state: Tuple[bytes, List[str]]) -> UsedWordSet:
+    return UsedWordSet.from_bits(_worker_lexicon[2], *state)
+
+
+def _copy_for_worker(word_set: UsedWordSet) -> Tuple[bytes, List[str]]:
+    """Raw bits and out-of-lexicon words: cheap to pickle, unlike the compressed persistence format."""
+    return bytes(word_set.bits), list(word_set.extra)
+
+
+def _rank_game_words_in_worker(strategy, label, start_letter, min_length, used_state, cursor, exclude_state, count):
+    vocabulary = _worker_lexicon[0]
+    candidates, excluded = rank_game_words(vocabulary, strategy, label, start_letter, min_length, _word_set(used_state), cursor, _word_set(exclude_state), count)
+    return candidates, excluded, cursor
+
+
+def _rank_retry_words_in_worker(start_letter, min_length, used_state, exclude_state, count):
+    return rank_retry_words(_worker_lexicon[1], start_letter, min_length, _word_set(used_state), _word_set(exclude_state), count)
+
+
+class SelectionPool:
+    """
+    Runs word selection off the event loop.
+    thread: workers share the bot's lexicon and read the live used word sets.
+    process: each worker maps the same lexicon file read-only; used word bitsets are copied in
+    and cursor updates copied back, so selection never holds the GIL of the bot process.
+    inline: runs on the event loop, as before.
+    """
+
+    def __init__(self, kind: str, workers: int, vocabulary: Vocabulary, retry_lexicon: RetryLexicon, word_index: WordIndex, lexicon_file: str):
+        self.kind = kind
+        self.vocabulary = vocabulary
+        self.retry_lexicon = retry_lexicon
+        self.word_index = word_index
+        workers = workers or min(4, os.cpu_count() or 1)
+        self.executor: Optional[Executor] = None
+        if kind == "thread":
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="selection")
+        elif kind == "process":
+            self.executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(lexicon_file, word_index.fingerprint))
+        elif kind != "inline":
+            raise ValueError(f"Unknown selection pool {kind!r}, expected thread, process or inline")
+
+    async def _run(self, function, *args):
+        if self.executor is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def rank_game_words(self, strategy: Optional[str], label: str, start_letter: str, min_length: int, used: UsedWordSet,
+                              cursor: Cursor, exclude: UsedWordSet, count: int = 1) -> Tuple[List[Candidate], bool]:
+        if self.kind != "process":
+            return await self._run(rank_game_words, self.vocabulary, strategy, label, start_letter, min_length, used, cursor, exclude, count)
+        candidates, excluded, moved = await self._run(_rank_game_words_in_worker, strategy, label, start_letter, min_length,
+                                                      _copy_for_worker(used), dict(cursor), _copy_for_worker(exclude), count)
+        for key, pos in moved.items():
+            if pos > cursor.get(key, 0):
+                cursor[key] = pos
+        return candidates, excluded
+
+    async def rank_retry_words(self, start_letter: str, min_length: int, used: UsedWordSet, exclude: UsedWordSet,
+                               count: int = 1) -> Tuple[List[str], bool]:
+        if self.kind != "process":
+            return await self._run(rank_retry_words, self.retry_lexicon, start_letter, min_length, used, exclude, count)
+        return await self._run(_rank_retry_words_in_worker, start_letter, min_length, _copy_for_worker(used), _copy_for_worker(exclude), count)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
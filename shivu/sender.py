@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from pyrogram.errors import FloodWait
+
+# Outbound priorities, most urgent first
+PRIORITY_GAME = 0
+PRIORITY_ADMIN = 1
+PRIORITY_LOG = 2
+PRIORITY_NAMES = ('game', 'admin', 'log')
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def parse_log_level(value: str) -> int:
+    """A logging level given as a number or a level name in any case, e.g. 40, error or ERROR."""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value.upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level {value!r}, expected a number or one of DEBUG, INFO, WARNING, ERROR, CRITICAL")
+    return level
+
+
+class TokenBucket:
+    """Allows rate sends per second on average, with bursts of up to burst sends."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _Outgoing:
+    __slots__ = ('chat_id', 'text', 'priority', 'kwargs', 'future')
+
+    def __init__(self, chat_id: int, text: str, priority: int, kwargs: Dict[str, Any], future: asyncio.Future):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.text = text
+        self.kwargs = kwargs
+        self.future = future
+
+
+class SendScheduler:
+    """
+    Sends messages from one queue per priority: game replies before admin responses before log messages.
+    Sends are paced by a token bucket. A FloodWait only blocks the chat it was raised for, and every queue
+    skips blocked chats, so a penalty on the log chat never holds up game replies elsewhere.
+    At most one message per chat is in flight, which keeps each chat's messages in order.
+    """
+
+    def __init__(self, send: Callable[..., Awaitable[Any]], rate: float = 20.0, burst: int = 5,
+                 on_flood_wait: Optional[Callable[[int, float], None]] = None):
+        self.send = send
+        self.on_flood_wait = on_flood_wait  # on_flood_wait(chat_id, seconds) whenever a chat is backed off
+        self.bucket = TokenBucket(rate, burst)
+        self.queues: List[Deque[_Outgoing]] = [deque(), deque(), deque()]
+        self.blocked_until: Dict[int, float] = {}  # chat_id -> monotonic time its FloodWait ends
+        self.in_flight: Set[int] = set()
+        self.deliveries: Set[asyncio.Task] = set()  # Referenced until done so they are never garbage collected
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def post(self, chat_id: int, text: str, priority: int = PRIORITY_LOG, **kwargs) -> asyncio.Future:
+        """Queue a message without waiting. The returned future resolves to the sent message or the send error."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].append(_Outgoing(chat_id, text, priority, kwargs, future))
+        self.wakeup.set()
+        return future
+
+    async def submit(self, chat_id: int, text: str, priority: int = PRIORITY_GAME, **kwargs) -> Any:
+        """Queue a message and wait until it is sent. Returns the sent message or raises the send error."""
+        return await self.post(chat_id, text, priority, **kwargs)
+
+    async def drain(self, timeout: float = 10.0):
+        """Wait up to timeout seconds for the messages queued or in flight so far to be sent, e.g. before shutting down."""
+        futures = [item.future for queue in self.queues for item in queue] + list(self.deliveries)
+        if futures:
+            await asyncio.wait(futures, timeout=timeout)
+
+    async def stop(self):
+        """Stop sending: cancel the scheduler task and any delivery still in flight. Queued messages are dropped."""
+        tasks = list(self.deliveries)
+        if self.task is not None:
+            tasks.append(self.task)
+            self.task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _next_ready(self, peek: bool = False) -> Optional[_Outgoing]:
+        """Most urgent queued message whose chat is neither blocked nor busy, removed from its queue unless peek."""
+        now = time.monotonic()
+        for queue in self.queues:
+            for item in queue:
+                if item.chat_id not in self.in_flight and self.blocked_until.get(item.chat_id, 0) <= now:
+                    if not peek:
+                        queue.remove(item)
+                    return item
+        return None
+
+    def _next_unblock(self) -> Optional[float]:
+        now = time.monotonic()
+        waits = [until - now for until in self.blocked_until.values() if until > now]
+        return min(waits) if waits else None
+
+    async def run(self):
+        while True:
+            if self._next_ready(peek=True) is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self._next_unblock())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.bucket.acquire()
+            # Pick after the token wait so anything more urgent queued meanwhile goes first
+            item = self._next_ready()
+            if item is None:
+                continue
+            self.in_flight.add(item.chat_id)
+            delivery = asyncio.create_task(self._deliver(item))
+            self.deliveries.add(delivery)
+            delivery.add_done_callback(self.deliveries.discard)
+
+    async def _deliver(self, item: _Outgoing):
+        try:
+            message = await self.send(item.chat_id, item.text, **item.kwargs)
+        except FloodWait as e:
+            # Back off this chat only and retry the message first once the wait is over
+            self.blocked_until[item.chat_id] = time.monotonic() + e.value
+            if self.on_flood_wait is not None:
+                self.on_flood_wait(item.chat_id, e.value)
+            self.queues[item.priority].appendleft(item)
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            self.blocked_until.pop(item.chat_id, None)
+            if not item.future.done():
+                item.future.set_result(message)
+        finally:
+            self.in_flight.discard(item.chat_id)
+            self.wakeup.set()
+
+
+class LogDigest:
+    """
+    Collects log chat events and sends them as one digest message every interval seconds,
+    or as soon as max_events are waiting. Digests are split to fit Telegram's message length limit.
+    Events at or above immediate_level skip the digest and are sent right away.
+    """
+
+    def __init__(self, post: Callable[[str, bool], Any], interval: float = 10.0, max_events: int = 50,
+                 immediate_level: int = logging.ERROR):
+        self.post = post  # post(text, urgent)
+        self.interval = interval
+        self.max_events = max_events
+        self.immediate_level = immediate_level
+        self.events: List[str] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, text: str, level: int = logging.INFO):
+        if level >= self.immediate_level:
+            self.post(text, True)
+            return
+        self.events.append(f"{time.strftime('%H:%M:%S')} {text}")
+        if len(self.events) >= self.max_events:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.events:
+            return
+        events, self.events = self.events, []
+        for chunk in self.chunks(events):
+            self.post(chunk, False)
+
+    @staticmethod
+    def chunks(events: List[str], limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+        """Join events one per line into as few messages of at most limit characters as possible."""
+        chunks: List[str] = []
+        current = ''
+        for event in events:
+            for start in range(0, len(event), limit):
+                piece = event[start:start + limit]
+                if current and len(current) + 1 + len(piece) > limit:
+                    chunks.append(current)
+                    current = ''
+                current = f"{current}\n{piece}" if current else piece
+        if current:
+            chunks.append(current)
+        return chunks
@@ -0,0 +1,105 @@
+"""
+Runs one bot process per user session, all sharing one SQLite state store.
+
+    SESSION_STRINGS=<session 1>,<session 2>,... python -m shivu.shards
+
+Shard i gets SESSION_STRING, SHARD_INDEX=i and SHARD_COUNT, serves the chats assigned to it and
+runs admin commands only for those. A shard receiving /on, /off, /clear or /usedwords for another
+shard's chat forwards it through the shared store, and the owning shard picks it up within
+COMMAND_POLL_INTERVAL seconds. Shards that exit are restarted.
+
+Every session must be a member of the log chat (LOG_CHAT_ID), where the owning shard posts its replies.
+Add every session to the chat admins send commands in as well: /runs only lists the chats of the shards
+that received it, and a command reaches its chat only while some shard that received it is running.
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from shivu import LOGGER
+
+RESTART_DELAY = 5.0  # Seconds before restarting a shard that exited
+
+
+def shard_for(chat_id: int, shard_count: int) -> int:
+    """Default shard of a chat when /on does not pin one."""
+    return chat_id % shard_count
+
+
+def chat_shard(chat_id: int, info: Optional[Dict[str, Any]], shard_count: int) -> int:
+    """Shard serving an enabled chat: the one recorded when it was enabled, else the default."""
+    if info is not None and 'shard' in info:
+        return int(info['shard']) % shard_count
+    return shard_for(chat_id, shard_count)
+
+
+def migrate_state(sqlite_file: str, config_file: str):
+    """Import a JSON config into the shared store once, before any shard starts reading it."""
+    from shivu.storage import SqliteBackend
+
+    async def migrate():
+        backend = SqliteBackend(sqlite_file, migrate_from=config_file)
+        await backend.load_chats()
+        await backend.close()
+
+    asyncio.run(migrate())
+
+
+class Coordinator:
+    """Starts the shard processes, restarts any that exit and stops them all on SIGINT or SIGTERM."""
+
+    def __init__(self, sessions: List[str], env: Dict[str, str]):
+        self.sessions = sessions
+        self.env = env
+        self.processes: List[Optional[subprocess.Popen]] = [None] * len(sessions)
+        self.exited_at: Dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self, index: int):
+        env = dict(self.env, SESSION_STRING=self.sessions[index], SHARD_INDEX=str(index), SHARD_COUNT=str(len(self.sessions)))
+        self.processes[index] = subprocess.Popen([sys.executable, "-m", "shivu"], env=env)
+        LOGGER.info(f"Started shard {index} (pid {self.processes[index].pid})")
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(len(self.sessions)):
+            self.spawn(index)
+        while not self.stopping:
+            time.sleep(1)
+            for index, process in enumerate(self.processes):
+                if process.poll() is None:
+                    continue
+                exited_at = self.exited_at.setdefault(index, time.monotonic())
+                if time.monotonic() - exited_at >= RESTART_DELAY:
+                    LOGGER.warning(f"Shard {index} exited with code {process.returncode}, restarting")
+                    del self.exited_at[index]
+                    self.spawn(index)
+        for process in self.processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)  # Lets each shard flush its pending state
+        for process in self.processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    sessions = [session.strip() for session in os.getenv("SESSION_STRINGS", "").split(",") if session.strip()]
+    if not sessions:
+        sys.exit("Set SESSION_STRINGS to a comma separated list of session strings, one per shard")
+    env = dict(os.environ, STORAGE_BACKEND="sqlite")  # The only store shards can share
+    migrate_state(env.get("SQLITE_FILE", "chat_state.db"), "chat_config.json")
+    Coordinator(sessions, env).run()
+
+
+if __name__ == "__main__":
+    main()
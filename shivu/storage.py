@@ -0,0 +1,478 @@
+import asyncio
+import glob
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import aiofiles
+
+from shivu import LOGGER
+
+ChatState = Tuple[Dict[int, Dict[str, Any]], Dict[int, Set[str]]]  # (enabled_chats, used_words)
+WordSetFactory = Callable[..., Set[str]]  # Builds a used word set from an iterable of words or a persisted state
+
+
+# Journal records, one JSON object per line
+def words_record(chat_id: int, words: List[str]) -> Dict[str, Any]:
+    return {'op': 'words', 'chat': chat_id, 'words': words}
+
+
+def clear_record(chat_id: int) -> Dict[str, Any]:
+    return {'op': 'clear', 'chat': chat_id}
+
+
+def enable_record(chat_id: int, info: Dict[str, Any]) -> Dict[str, Any]:
+    return {'op': 'enable', 'chat': chat_id, 'info': info}
+
+
+def disable_record(chat_id: int) -> Dict[str, Any]:
+    return {'op': 'disable', 'chat': chat_id}
+
+
+def update_record(chat_id: int, info: Dict[str, Any]) -> Dict[str, Any]:
+    """Set some fields of an enabled chat's info, keeping the rest."""
+    return {'op': 'update', 'chat': chat_id, 'info': info}
+
+
+def apply_record(record: Dict[str, Any], enabled_chats: Dict[int, Dict[str, Any]], used_words: Dict[int, Set[str]],
+                 new_set: WordSetFactory = set):
+    chat_id = int(record['chat'])
+    op = record['op']
+    if op == 'words':
+        if chat_id not in used_words:
+            used_words[chat_id] = new_set()
+        used_words[chat_id].update(record['words'])
+    elif op == 'clear':
+        used_words[chat_id] = new_set()
+    elif op == 'enable':
+        enabled_chats[chat_id] = record['info']
+        used_words[chat_id] = new_set()
+    elif op == 'disable':
+        enabled_chats.pop(chat_id, None)
+        used_words.pop(chat_id, None)
+    elif op == 'update':
+        if chat_id in enabled_chats:
+            enabled_chats[chat_id] = {**enabled_chats[chat_id], **record['info']}
+
+
+class ConfigJournal:
+    """
+    Chat config persisted as a JSON snapshot plus append-only journals.
+    Every change is one appended line in chat_config.json.journal.<generation>; the snapshot names the
+    first generation that is not folded into it. Compaction starts a new generation, writes the snapshot
+    to a temporary file and renames it into place in the background, then drops the older journals.
+    A crash at any point leaves either the old or the new snapshot plus every journal it still needs,
+    and a torn last line is cut off on load so later records start on a line of their own.
+    """
+
+    def __init__(self, snapshot_path: str, state: Callable[[], ChatState], compact_after: int = 2000,
+                 new_set: WordSetFactory = set):
+        self.snapshot_path = snapshot_path
+        self.state = state
+        self.compact_after = compact_after
+        self.new_set = new_set
+        self.generation = 0
+        self.pending = 0  # Records appended since the last snapshot
+        self.torn = False  # The last append failed and may have left a partial line
+        self.compaction: Optional[asyncio.Task] = None
+
+    def journal_path(self, generation: int) -> str:
+        return f"{self.snapshot_path}.journal.{generation}"
+
+    def journal_generations(self) -> List[int]:
+        generations = []
+        for path in glob.glob(f"{glob.escape(self.snapshot_path)}.journal.*"):
+            suffix = path.rsplit('.', 1)[1]
+            if suffix.isdigit():
+                generations.append(int(suffix))
+        return sorted(generations)
+
+    async def load(self) -> ChatState:
+        """Read the snapshot and replay every journal not yet folded into it."""
+        enabled_chats: Dict[int, Dict[str, Any]] = {}
+        used_words: Dict[int, Set[str]] = {}
+        generation = 0
+        if os.path.exists(self.snapshot_path):
+            async with aiofiles.open(self.snapshot_path, 'r') as f:
+                data = json.loads(await f.read())
+            enabled_chats = {int(k): v for k, v in data.get('enabled_chats', {}).items()}
+            used_words = {int(k): self.new_set(v) for k, v in data.get('used_words', {}).items()}
+            generation = data.get('journal', 0)
+
+        self.pending = 0
+        generations = [g for g in self.journal_generations() if g >= generation]
+        for g in generations:
+            async with aiofiles.open(self.journal_path(g), 'rb') as f:
+                data = await f.read()
+            if g == generations[-1] and data and not data.endswith(b'\n'):
+                # A torn last line: cut it off so the next append does not land on the same line
+                complete = data.rfind(b'\n') + 1
+                LOGGER.warning(f"Dropping torn journal record at the end of {self.journal_path(g)}")
+                os.truncate(self.journal_path(g), complete)
+                data = data[:complete]
+            lines = data.decode('utf-8', errors='replace').splitlines()
+            for line_no, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    apply_record(json.loads(line), enabled_chats, used_words, self.new_set)
+                    self.pending += 1
+                except (ValueError, KeyError) as e:
+                    LOGGER.warning(f"Skipping unreadable journal record {self.journal_path(g)}:{line_no}: {e}")
+        self.generation = max(generations, default=generation)
+        return enabled_chats, used_words
+
+    async def append(self, *records: Dict[str, Any]) -> int:
+        """Append records to the current journal and return the bytes written. The in-memory state must already include them."""
+        data = ''.join(json.dumps(record) + '\n' for record in records)
+        if self.torn:
+            data = '\n' + data  # Start on a new line after a write that failed part way
+        try:
+            async with aiofiles.open(self.journal_path(self.generation), 'a') as f:
+                await f.write(data)
+        except Exception:
+            self.torn = True
+            raise
+        self.torn = False
+        self.pending += len(records)
+        if self.pending >= self.compact_after and self.compaction is None:
+            self.compaction = asyncio.create_task(self.compact())
+        return len(data.encode())
+
+    async def compact(self):
+        """Fold the current state into a new snapshot and drop the journals it covers."""
+        try:
+            enabled_chats, used_words = self.state()
+            # Copy state and switch generation without awaiting, so later records land in the new journal
+            self.generation += 1
+            self.pending = 0
+            self.torn = False
+            snapshot = {
+                'enabled_chats': {k: dict(v) for k, v in enabled_chats.items()},
+                'used_words': {k: v.to_state() if hasattr(v, 'to_state') else list(v) for k, v in used_words.items()},
+                'journal': self.generation,
+            }
+            await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot, snapshot)
+            for g in self.journal_generations():
+                if g < snapshot['journal']:
+                    os.remove(self.journal_path(g))
+        except Exception as e:
+            LOGGER.error(f"Failed to compact {self.snapshot_path}: {e}")
+        finally:
+            self.compaction = None
+
+    def _write_snapshot(self, snapshot: Dict[str, Any]):
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+
+class StorageBackend:
+    """Persistent home of enabled_chats and used_words. Subclasses implement the storage format."""
+
+    async def load_chats(self) -> Dict[int, Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def load_words(self, chat_id: int) -> Set[str]:
+        raise NotImplementedError
+
+    async def list_words(self, chat_id: int) -> List[str]:
+        return sorted(await self.load_words(chat_id))
+
+    async def write(self, records: List[Dict[str, Any]]) -> Optional[int]:
+        """Persist records in order. Returns the number of bytes written, or None if the format cannot tell."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class JsonBackend(StorageBackend):
+    """chat_config.json snapshot plus journal. The whole file is read at startup and kept in memory."""
+
+    def __init__(self, path: str, compact_after: int = 2000, new_set: WordSetFactory = set):
+        self.enabled_chats: Dict[int, Dict[str, Any]] = {}
+        self.used_words: Dict[int, Set[str]] = {}
+        self.new_set = new_set
+        self.journal = ConfigJournal(path, lambda: (self.enabled_chats, self.used_words), compact_after, new_set)
+
+    async def load_chats(self) -> Dict[int, Dict[str, Any]]:
+        self.enabled_chats, self.used_words = await self.journal.load()
+        return {chat_id: dict(info) for chat_id, info in self.enabled_chats.items()}
+
+    async def load_words(self, chat_id: int) -> Set[str]:
+        return self.new_set(self.used_words.get(chat_id, ()))
+
+    async def write(self, records: List[Dict[str, Any]]) -> Optional[int]:
+        for record in records:
+            apply_record(record, self.enabled_chats, self.used_words, self.new_set)
+        return await self.journal.append(*records)
+
+    async def close(self):
+        if self.journal.compaction is not None:
+            await self.journal.compaction
+
+
+class SqliteBackend(StorageBackend):
+    """
+    SQLite database with one row per enabled chat and one row per (chat, used word).
+    Queries run on a dedicated thread. If the database is empty and a JSON config exists at migrate_from,
+    it is imported on first load and its files are renamed with a .migrated suffix.
+    """
+
+    def __init__(self, path: str, migrate_from: Optional[str] = None, new_set: WordSetFactory = set):
+        self.path = path
+        self.migrate_from = migrate_from
+        self.new_set = new_set
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.db: Optional[sqlite3.Connection] = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, info TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS used_words (chat_id INTEGER NOT NULL, word TEXT NOT NULL, "
+                "PRIMARY KEY (chat_id, word)) WITHOUT ROWID"
+            )
+            # Admin commands handed between shards: forwarded to the owning shard, claimed by whichever runs it
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS forwarded_commands (key TEXT PRIMARY KEY, shard INTEGER NOT NULL, "
+                "command TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self.db.execute("CREATE TABLE IF NOT EXISTS claimed_commands (key TEXT PRIMARY KEY, created REAL NOT NULL)")
+            self.db.commit()
+        return self.db
+
+    async def load_chats(self) -> Dict[int, Dict[str, Any]]:
+        db = await self._run(self._connect)
+        if self.migrate_from and os.path.exists(self.migrate_from):
+            empty = await self._run(lambda: db.execute("SELECT 1 FROM chats LIMIT 1").fetchone() is None)
+            if empty:
+                await self._migrate()
+        rows = await self._run(lambda: db.execute("SELECT chat_id, info FROM chats").fetchall())
+        return {chat_id: json.loads(info) for chat_id, info in rows}
+
+    async def _migrate(self):
+        source = JsonBackend(self.migrate_from, new_set=self.new_set)
+        enabled_chats = await source.load_chats()
+        records = [enable_record(chat_id, info) for chat_id, info in enabled_chats.items()]
+        records += [words_record(chat_id, sorted(words)) for chat_id, words in source.used_words.items()]
+        await self.write(records)
+        for path in [self.migrate_from] + [source.journal.journal_path(g) for g in source.journal.journal_generations()]:
+            os.replace(path, f"{path}.migrated")
+        LOGGER.info(f"Migrated {len(enabled_chats)} chats from {self.migrate_from} to {self.path}")
+
+    async def load_words(self, chat_id: int) -> Set[str]:
+        return self.new_set(await self.list_words(chat_id))
+
+    async def list_words(self, chat_id: int) -> List[str]:
+        rows = await self._run(lambda: self.db.execute("SELECT word FROM used_words WHERE chat_id = ? ORDER BY word", (chat_id,)).fetchall())
+        return [word for word, in rows]
+
+    async def write(self, records: List[Dict[str, Any]]) -> Optional[int]:
+        await self._run(self._write, records)
+        return None
+
+    def _write(self, records: List[Dict[str, Any]]):
+        with self.db:
+            for record in records:
+                chat_id = int(record['chat'])
+                op = record['op']
+                if op == 'words':
+                    self.db.executemany("INSERT OR IGNORE INTO used_words (chat_id, word) VALUES (?, ?)", [(chat_id, word) for word in record['words']])
+                elif op == 'enable':
+                    self.db.execute("INSERT OR REPLACE INTO chats (chat_id, info) VALUES (?, ?)", (chat_id, json.dumps(record['info'])))
+                elif op == 'update':
+                    row = self.db.execute("SELECT info FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+                    if row is not None:
+                        self.db.execute("UPDATE chats SET info = ? WHERE chat_id = ?", (json.dumps({**json.loads(row[0]), **record['info']}), chat_id))
+                if op in ('clear', 'enable', 'disable'):
+                    self.db.execute("DELETE FROM used_words WHERE chat_id = ?", (chat_id,))
+                if op == 'disable':
+                    self.db.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+
+    async def forward_command(self, key: str, shard: int, command: Dict[str, Any]):
+        """Queue a command for another shard. Shards that all received the same command forward it once."""
+        def forward():
+            with self.db:
+                self.db.execute("INSERT OR IGNORE INTO forwarded_commands (key, shard, command, created) VALUES (?, ?, ?, ?)",
+                                (key, shard, json.dumps(command), time.time()))
+        await self._run(forward)
+
+    async def take_commands(self, shard: int) -> List[Dict[str, Any]]:
+        """Remove and return the commands forwarded to a shard, oldest first."""
+        def take():
+            with self.db:
+                rows = self.db.execute("SELECT key, command FROM forwarded_commands WHERE shard = ? ORDER BY created", (shard,)).fetchall()
+                self.db.executemany("DELETE FROM forwarded_commands WHERE key = ?", [(key,) for key, _ in rows])
+            return [json.loads(command) for _, command in rows]
+        return await self._run(take)
+
+    async def claim_command(self, key: str, keep_for: float = 3600.0) -> bool:
+        """True only for the first claim of a command, so it runs once; claims older than keep_for seconds are dropped."""
+        def claim():
+            with self.db:
+                self.db.execute("DELETE FROM claimed_commands WHERE created < ?", (time.time() - keep_for,))
+                return self.db.execute("INSERT OR IGNORE INTO claimed_commands (key, created) VALUES (?, ?)", (key, time.time())).rowcount == 1
+        return await self._run(claim)
+
+    async def close(self):
+        if self.db is not None:
+            await self._run(self.db.close)
+            self.db = None
+        self.executor.shutdown(wait=False)
+
+
+def create_backend(kind: str, config_file: str, sqlite_file: str, new_set: WordSetFactory = set) -> StorageBackend:
+    if kind == 'json':
+        return JsonBackend(config_file, new_set=new_set)
+    if kind == 'sqlite':
+        return SqliteBackend(sqlite_file, migrate_from=config_file, new_set=new_set)
+    raise ValueError(f"Unknown storage backend {kind!r}, expected 'json' or 'sqlite'")
+
+
+class UsedWordsCache(dict):
+    """
+    chat_id -> set of used words, loaded from the backend on a chat's first activity.
+    With a capacity, the least recently loaded chats beyond it are evicted unless keep(chat_id) holds,
+    e.g. while they still have unsaved changes or a handler is between awaits on their set.
+    """
+
+    def __init__(self, backend: StorageBackend, capacity: Optional[int] = None,
+                 keep: Callable[[int], bool] = lambda chat_id: False):
+        super().__init__()
+        self.backend = backend
+        self.capacity = capacity
+        self.keep = keep
+
+    async def load(self, chat_id: int) -> Set[str]:
+        if chat_id in self:
+            words = self.pop(chat_id)  # Re-insert below to mark as most recently used
+        else:
+            words = await self.backend.load_words(chat_id)
+            words = self.pop(chat_id, words)  # Another handler may have loaded it meanwhile
+        self[chat_id] = words
+        self.evict()
+        return words
+
+    def evict(self):
+        if self.capacity is None or len(self) <= self.capacity:
+            return
+        for chat_id in list(self)[:-1]:  # Never the chat just loaded
+            if len(self) <= self.capacity:
+                break
+            if not self.keep(chat_id):
+                del self[chat_id]
+
+
+class ChatStateManager:
+    """
+    Buffers chat config records in memory and flushes them to the backend from a background task,
+    every flush_interval seconds or as soon as flush_threshold changes are pending, so handlers never
+    wait on file I/O. Records are kept per dirty chat, consecutive word records merged into one.
+    """
+
+    def __init__(self, backend: StorageBackend, flush_interval: float = 2.0, flush_threshold: int = 200,
+                 on_error: Optional[Callable[[Exception], Awaitable[None]]] = None,
+                 on_flush: Optional[Callable[[int, Optional[int], float], None]] = None):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.on_error = on_error
+        self.on_flush = on_flush  # on_flush(records, bytes written or None, seconds) after each successful write
+        self.dirty: Dict[int, List[Dict[str, Any]]] = {}  # chat_id -> pending records, oldest first
+        self.flushing: Dict[int, List[Dict[str, Any]]] = {}  # Batch currently being written
+        self.pending = 0
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+        self.stopping = False
+
+    def record(self, *records: Dict[str, Any]):
+        """Queue records whose changes are already applied in memory."""
+        for record in records:
+            chat_records = self.dirty.setdefault(int(record['chat']), [])
+            if record['op'] == 'words' and chat_records and chat_records[-1]['op'] == 'words':
+                chat_records[-1] = words_record(record['chat'], chat_records[-1]['words'] + record['words'])
+            elif record['op'] == 'update' and self._merge_update(chat_records, record):
+                continue  # Progress updates arrive with most messages; one per chat and flush is enough
+            else:
+                chat_records.append(record)
+            self.pending += 1
+        if self.pending >= self.flush_threshold:
+            self.wakeup.set()
+
+    @staticmethod
+    def _merge_update(chat_records: List[Dict[str, Any]], record: Dict[str, Any]) -> bool:
+        """Fold an update into the chat's pending update, unless an enable or disable came after it."""
+        for i in range(len(chat_records) - 1, -1, -1):
+            op = chat_records[i]['op']
+            if op == 'update':
+                chat_records[i] = update_record(record['chat'], {**chat_records[i]['info'], **record['info']})
+                return True
+            if op in ('enable', 'disable'):
+                return False
+        return False
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.lock:  # Batches must reach the backend in order
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, {}
+            pending, self.pending = self.pending, 0
+            records = [record for chat_records in dirty.values() for record in chat_records]
+            self.flushing = dirty
+            started = time.perf_counter()
+            try:
+                written = await self.backend.write(records)
+            except Exception as e:
+                # Put the batch back in front of anything recorded meanwhile and retry on the next flush
+                for chat_id, chat_records in self.dirty.items():
+                    dirty.setdefault(chat_id, []).extend(chat_records)
+                self.dirty = dirty
+                self.pending += pending
+                if self.on_error is not None:
+                    await self.on_error(e)
+            else:
+                if self.on_flush is not None:
+                    self.on_flush(len(records), written, time.perf_counter() - started)
+            finally:
+                self.flushing = {}
+
+    def is_dirty(self, chat_id: int) -> bool:
+        return chat_id in self.dirty or chat_id in self.flushing
+
+    async def stop(self):
+        """Stop the background task and write out everything still pending."""
+        self.stopping = True
+        self.wakeup.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+        await self.flush()
+        await self.backend.close()